@@ -12,12 +12,35 @@ from utils import orientation
 from utils.frequency import ridge_freq
 from utils.gabor_filter import gabor_filter
 from utils.skeletonize import skeletonize
-from utils.crossing_number import calculate_minutiaes
+from utils.crossing_number import extract_minutiaes, draw_minutiaes, minutiaes_to_list
 from utils.poincare import calculate_singularities
+from model.identification import IdentificationService, claim_finger, parse_top_k
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# gallery nạp một lần khi khởi động, dùng chung cho mọi request /api/identify, /api/verify
+identification_service = None
+
+def get_identification_service():
+    global identification_service
+    if identification_service is None:
+        identification_service = IdentificationService()
+    return identification_service
+
+def read_uploaded_image():
+    """Ảnh xám từ trường file của request, hoặc (response lỗi, status)"""
+    if 'file' not in request.files:
+        return None, (jsonify({'error': 'Không có file được upload'}), 400)
+    file = request.files['file']
+    if file.filename == '':
+        return None, (jsonify({'error': 'Chưa chọn file'}), 400)
+    file_bytes = np.frombuffer(file.read(), np.uint8)
+    input_img = cv.imdecode(file_bytes, cv.IMREAD_GRAYSCALE)
+    if input_img is None:
+        return None, (jsonify({'error': 'Không thể đọc ảnh. Vui lòng upload file ảnh hợp lệ'}), 400)
+    return input_img, None
+
 def image_to_base64(img):
     """Chuyển ảnh numpy array sang base64 string"""
     if len(img.shape) == 2:
@@ -61,7 +84,7 @@ def process_fingerprint_step_by_step(input_img):
     })
     
     # BƯỚC 4: Định hướng (Orientation)
-    angles = orientation.calculate_angles(normalized_img, W=block_size, smoth=False)
+    angles, coherence = orientation.calculate_angles(normalized_img, W=block_size, smoth=False, return_coherence=True)
     orientation_img = orientation.visualize_angles(segmented_img, mask, angles, W=block_size)
     steps.append({
         'step': 4,
@@ -102,13 +125,15 @@ def process_fingerprint_step_by_step(input_img):
     })
     
     # BƯỚC 8: Điểm đặc trưng Minutiae
-    minutias_img = calculate_minutiaes(thin_image)
+    minutiaes = extract_minutiaes(thin_image, angles=angles, coherence=coherence, W=block_size)
+    minutias_img = draw_minutiaes(thin_image, minutiaes)
     steps.append({
         'step': 8,
         'name': 'Điểm đặc trưng (Minutiae Detection)',
         'description': 'Phát hiện các điểm đặc trưng: điểm kết thúc (termination - màu đỏ) và điểm phân nhánh (bifurcation - màu xanh lá)',
         'image': image_to_base64(minutias_img),
-        'details': 'Crossing number method'
+        'details': f'Crossing number method, {len(minutiaes)} minutiae',
+        'minutiae': minutiaes_to_list(minutiaes)
     })
     
     # BƯỚC 9: Điểm kỳ dị (Singularities)
@@ -155,6 +180,44 @@ def process():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/identify', methods=['POST'])
+def identify():
+    """Nhận dạng 1:N: top-k template khớp nhất trong gallery, kèm thời gian từng bước"""
+    try:
+        input_img, error = read_uploaded_image()
+        if error:
+            return error
+        k = parse_top_k(request.form.get('k'))
+        if k is None:
+            return jsonify({'error': 'Trường k phải là số nguyên dương'}), 400
+        
+        result = get_identification_service().identify(input_img, k)
+        return jsonify({'success': True, **result})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/verify', methods=['POST'])
+def verify():
+    """Xác thực 1:1: so ảnh với các template của ngón tay được khai báo (trường claim, vd. DB1/101)"""
+    try:
+        input_img, error = read_uploaded_image()
+        if error:
+            return error
+        claim = request.form.get('claim')
+        if not claim:
+            return jsonify({'error': 'Thiếu trường claim (mã ngón tay, vd. DB1/101)'}), 400
+        if claim_finger(claim) is None:
+            return jsonify({'error': f'claim không hợp lệ: {claim} (mã ngón tay, vd. DB1/101)'}), 400
+        
+        result = get_identification_service().verify(input_img, claim)
+        if result is None:
+            return jsonify({'error': f'Không có template nào của {claim} trong gallery'}), 404
+        return jsonify({'success': True, **result})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/demo', methods=['GET'])
 def demo():
     """Load một ảnh demo từ dataset"""
@@ -199,6 +262,9 @@ if __name__ == '__main__':
     # Tạo thư mục templates nếu chưa có
     os.makedirs('templates', exist_ok=True)
     
+    service = get_identification_service()
+    print(f"🗂️ Gallery: {service.path} ({len(service)} template, nạp trong {service.load_time} ms)")
+    
     print("=" * 60)
     print("🚀 KHỞI ĐỘNG ỨNG DỤNG XỬ LÝ VÂN TAY")
     print("=" * 60)
@@ -2,6 +2,7 @@ import numpy as np
 import math
 import scipy.ndimage
 from .image_procesing import *
+from utils.frequency import ridge_freq_map
 def inmatrix(matrix):
     for i in matrix:
         for j in i:
@@ -48,22 +49,8 @@ def frequest(im, orientim, kernel_size, minWaveLength, maxWaveLength):
 
 def ridge_freq(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength):
     # Ước lượng tần suất đường vân
-    rows,cols = im.shape
-    freq = np.zeros((rows,cols))
-
-    for row in range(0, rows - block_size, block_size):
-        for col in range(0, cols - block_size, block_size):
-            image_block = im[row:row + block_size][:, col:col + block_size]
-            angle_block = orient[row // block_size][col // block_size]
-            if angle_block:
-                freq[row:row + block_size][:, col:col + block_size] = frequest(image_block, angle_block, kernel_size,
-                                                                               minWaveLength, maxWaveLength)
-    freq = freq*mask
-    freq_1d = np.reshape(freq,(1,rows*cols))
-    ind = np.where(freq_1d>0)
-    ind = np.array(ind)
-    ind = ind[1,:]
-    non_zero_elems_in_freq = freq_1d[0][ind]
-    medianfreq = np.median(non_zero_elems_in_freq) * mask
-
-    return medianfreq
\ No newline at end of file
+    # toàn bộ block được lấy mẫu một lần bởi utils.frequency.ridge_freq_map, giữ cách xoay của frequest
+    # ở trên: xoay block một góc orient - 90 độ rồi cộng theo hàng
+    _, medianfreq = ridge_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength,
+                                   rotation=-np.pi/2, projection_axis=1)
+    return medianfreq * mask
@@ -1,17 +1 @@
-from math import sqrt
-import numpy as np
-
-
-def normalize_pixel(x, v0, v, m, m0):
-    dev_coeff = sqrt((v0 * ((x - m)**2)) / v)
-    return m0 + dev_coeff if x > m else m0 - dev_coeff
-
-def normalize(im, m0, v0):
-    m = np.mean(im)
-    v = np.std(im) ** 2
-    (y, x) = im.shape
-    normilize_image = im.copy()
-    for i in range(x):
-        for j in range(y):
-            normilize_image[j, i] = normalize_pixel(im[j, i], v0, v, m, m0)
-    return normilize_image
+from utils.normalization import normalize_pixel, normalize
@@ -1,50 +1,29 @@
 import math
 import numpy as np
 import cv2 as cv
+from utils.orientation import block_orientation
 
 
 
-def calculate_angles(im, W):
+def calculate_angles(im, W, return_coherence=False):
     """
     :param im:
     :param W: int width of the ridge
+    :param return_coherence: trả về thêm độ tin cậy (coherence) của từng block
     :return: array
     """
-    j1 = lambda x, y: 2 * x * y
-    j2 = lambda x, y: x ** 2 - y ** 2
-    j3 = lambda x, y: x ** 2 + y ** 2
-
-    (y, x) = im.shape
-
     sobelOperator = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
     ySobel = np.array(sobelOperator).astype(int)
     xSobel = np.transpose(ySobel).astype(int)
 
-    result = [[] for i in range(1, y, W)]
     max_value = np.amax(im)
     Gx_ = cv.filter2D(im/max_value,-1, ySobel)*max_value
     Gy_ = cv.filter2D(im/max_value,-1, xSobel)*max_value
-    for j in range(1, y, W):
-        for i in range(1, x, W):
-            nominator = 0
-            denominator = 0
-            for l in range(j, min(j + W, y - 1)):
-                for k in range(i, min(i + W , x - 1)):
-                    Gx = round(Gx_[l, k])  # Tính gradient theo Ox tại (l, k)
-                    Gy = round(Gy_[l, k])  # Tính gradient theo Oy tại (l, k)
-                    nominator += j1(Gx, Gy)
-                    denominator += j2(Gx, Gy)
+    # tổng Gxy, Gxx - Gyy theo từng block tính một lần bằng ảnh tích phân
+    result, coherence = block_orientation(Gx_, Gy_, W)
 
-            if nominator or denominator:
-                angle = (math.pi + math.atan2(nominator, denominator)) / 2
-                # orientation = np.pi/2 + math.atan2(nominator,denominator)/2
-                result[int((j-1) // W)].append(angle)
-            else:
-                result[int((j-1) // W)].append(0)
-                # print(nominator)
-                # print(denominator)
-                
-    result = np.array(result)
+    if return_coherence:
+        return result, coherence
     return result
 
 def get_line_ends(i, j, W, tang):
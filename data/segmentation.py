@@ -1,9 +1,10 @@
 import numpy as np
 import cv2 as cv
 import math
+from utils.block_statistics import integral_images, block_mean_std, upsample_blocks
 
 
-def create_segmented_and_variance_images(im, w, threshold=.3):
+def create_segmented_and_variance_images(im, w, threshold=.3, tables=None):
     """
     Trả về mặt identifying ROI. Tính độ lệch chuẩn trong từng khối hình ảnh và ngưỡng ROI
     Nó cũng bình thường hóa các giá trị intesity của hình ảnh sao cho các vùng sườn núi có giá trị trung bình bằng 0, đơn vị độ chuẩn
@@ -11,22 +12,19 @@ def create_segmented_and_variance_images(im, w, threshold=.3):
     :param im: Image
     :param w: kích cỡ của block
     :param threshold: std ngưỡng
+    :param tables: (sat, squared_sat) của ảnh tính bởi utils.block_statistics.integral_images, None thì tự tính
     :return: segmented_image
     """
-    (y, x) = im.shape
     threshold = np.std(im)*threshold
 
-    image_variance = np.zeros(im.shape)
     segmented_image = im.copy()
-    mask = np.ones_like(im)
-    for i in range(0, x, w):
-        for j in range(0, y, w):
-            box = [i, j, min(i + w, x), min(j + w, y)]
-            block_stddev = np.std(im[box[1]:box[3], box[0]:box[2]])
-            image_variance[box[1]:box[3], box[0]:box[2]] = block_stddev
+    # độ lệch chuẩn của mọi block tính từ ảnh tích phân, chỉ mask được phóng lại kích thước ảnh
+    if tables is None:
+        tables = integral_images(im)
+    _, block_stddev = block_mean_std(tables, w)
 
     # loc theo nguong threshold
-    mask[image_variance < threshold] = 0
+    mask = upsample_blocks(block_stddev >= threshold, w, im.shape).astype(im.dtype)
     # lam muot anh
     kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE,(w*2, w*2))
     # for i in range(32):
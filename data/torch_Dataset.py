@@ -1,20 +1,47 @@
+import os
+import sys
 import numpy as np 
+import cv2 as cv
 import torch
 from torch.utils import data
 import pandas as pd
 from .image_procesing import read_image, show_image 
 
+INPUT_SIZE = 160
+
+def read_csver(path):
+	# cột path và identity của file csv, đọc một lần cả cột
+	infor_images = pd.read_csv(path)
+	return infor_images['path'].tolist(), infor_images['identity'].to_numpy()
+
+def packed_paths(prefix):
+	return prefix + '_images.npy', prefix + '_labels.npy'
+
+def pack_images(csv_path, prefix, size = INPUT_SIZE):
+	"""
+	Giải mã một lần mọi ảnh trong file csv, đổi kích thước về size x size và ghi vào một mảng uint8 liên tục
+	(prefix_images.npy, mở bằng memmap) cùng mảng nhãn (prefix_labels.npy).
+	:return: số ảnh đã đóng gói
+	"""
+	paths, labels = read_csver(csv_path)
+	images_path, labels_path = packed_paths(prefix)
+	images = np.lib.format.open_memmap(images_path + '.tmp', mode = 'w+', dtype = np.uint8, shape = (len(paths), size, size))
+	for index, path in enumerate(paths):
+		image = read_image(path)
+		if image is None:
+			raise IOError('không đọc được ảnh ' + path)
+		images[index] = image if image.shape == (size, size) else cv.resize(image, (size, size), interpolation = cv.INTER_AREA)
+	images.flush()
+	del images
+	np.save(labels_path, labels.astype(np.int64))
+	# ghi xong mới đổi tên, tránh để lại file đóng gói dở
+	os.replace(images_path + '.tmp', images_path)
+	return len(paths)
+
 class  image_Dataset(data.Dataset):
 	"""docstring for  image_Dataset"""
 	def read_csver(self, path):
-		infor_images = pd.read_csv(path)
-		paths = []
-		labels = []
-		for i  in range(  len(infor_images)):
-			paths.append(infor_images['path'][i])
-			labels.append(infor_images['identity'][i])
-
-		return paths,labels
+		return read_csver(path)
 
 	def __init__(self, path):
 		super( image_Dataset, self).__init__()
@@ -30,13 +57,48 @@ class  image_Dataset(data.Dataset):
 		x = torch.Tensor(x).float()
 		y = self.labels[index].long() 
 		return x,y
+
+class packed_Dataset(data.Dataset):
+	"""
+	Dataset đọc từ file đóng gói bởi pack_images: x là view uint8 (160, 160) trên memmap, không copy, không giải mã
+	ảnh; đổi sang float theo cả batch (x.float()) sau DataLoader.
+	"""
+	def __init__(self, prefix):
+		super(packed_Dataset, self).__init__()
+		self.images_path, labels_path = packed_paths(prefix)
+		self.labels = torch.from_numpy(np.load(labels_path))
+		self.images = None
+
+	def open(self):
+		# mở memmap trong từng tiến trình worker của DataLoader: các worker dùng chung page cache của file.
+		# copy-on-write để torch.from_numpy nhận mảng ghi được mà vẫn không copy dữ liệu
+		if self.images is None:
+			self.images = np.load(self.images_path, mmap_mode = 'c')
+		return self.images
+
+	def __getstate__(self):
+		# không pickle dữ liệu của memmap khi gửi dataset sang worker
+		state = self.__dict__.copy()
+		state['images'] = None
+		return state
+
+	def __len__(self):
+		return len(self.labels)
+
+	def __getitem__(self, index):
+		x = torch.from_numpy(self.open()[index])
+		y = self.labels[index]
+		return x,y
+
 def main():
 	dataset = image_Dataset('data_create_pretrainmodel.csv')
 	x,y = dataset.__getitem__(1)
 	# print(x.shape)
 
 if __name__ == '__main__':
-	pass
+	# python -m data.torch_Dataset data_create_pretrainmodel.csv data/dataset/pretrain
+	if len(sys.argv) == 3:
+		print(pack_images(sys.argv[1], sys.argv[2]), 'ảnh đã đóng gói vào', packed_paths(sys.argv[2])[0])
 	# main()
 
 
@@ -13,14 +13,16 @@ from tqdm import tqdm
 from utils.skeletonize import skeletonize
 
 
-def fingerprint_pipline(input_img):
+def fingerprint_pipline(input_img, normalized_img=None):
     block_size = 16
 
     # pipe line picture re https://www.cse.iitk.ac.in/users/biometrics/pages/111.JPG
     # normalization -> orientation -> frequency -> mask -> filtering
 
     # normalization - removes the effects of sensor noise and finger pressure differences.
-    normalized_img = normalize(input_img.copy(), float(100), float(100))
+    # the batch runner may pass an image it already normalized together with the whole stack
+    if normalized_img is None:
+        normalized_img = normalize(input_img, float(100), float(100))
 
     # color threshold
     # threshold_img = normalized_img
@@ -69,10 +71,15 @@ if __name__ == '__main__':
 
     images = open_images(img_dir)
 
+    # normalize the whole stack in one pass when every image has the same size
+    normalized_images = [None] * len(images)
+    if images.ndim == 3:
+        normalized_images = normalize(images, float(100), float(100))
+
     # image pipeline
     os.makedirs(output_dir, exist_ok=True)
     for i, img in enumerate(tqdm(images)):
-        results = fingerprint_pipline(img)
+        results = fingerprint_pipline(img, normalized_images[i])
         cv.imwrite(output_dir+str(i)+'.png', results)
         # cv.imshow('image pipeline', results); cv.waitKeyEx()
     
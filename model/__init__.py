@@ -3,3 +3,11 @@
 from .thinning import *
 from .minunate_detection import *
 from .calculate_distance import *
+from .matching import *
+from .pattern_class import *
+from .template_store import *
+from .triplet_index import *
+from .vector_index import *
+from .orientation_index import *
+from .extraction import *
+from .identification import *
@@ -4,6 +4,7 @@ from math import sqrt
 from math import cos, sin
 import numpy as np
 import json
+from .matching import pack_minutiaes, match_matrix, MINUTIAE_TYPES
 
 def calculate_distance(vector1, vector2):
     # Check if orientation values are None
@@ -14,78 +15,137 @@ def calculate_distance(vector1, vector2):
     dd = min(abs(vector1[3]-vector2[3]), 2*pi-abs(vector1[3]-vector2[3]))
     return (sd, dd)
 
-# def hough_transform(I, T, theta=5, err_theta=1, err_x=5, err_y=5, step_theta=5):
-#     delta_theta = np.arange(0, 360, step_theta)
-#     A = []
-#     for mt in T:
-#         for mi in I:
-#             for t in delta_theta:
-#                 tt = abs(180*mi[3]/pi + t - 180*mt[3]/pi)
-#                 dd = min(tt, 360-tt)
-#                 if(dd < theta):
-#                     mt_matrix = np.array([[mt[1]], [mt[2]]])
-#                     mi_matrix = np.array([[mi[1]], [mi[2]]])
-#                     rotation = np.array([[cos(t*pi/180), sin(t*pi/180)*(-1)], [sin(t*pi/180), cos(t*pi/180)]])
-#                     delta_x_y = mt_matrix - rotation.dot(mi_matrix)
-#                     delta_x = np.arange(delta_x_y[0]-err_x, delta_x_y[0]+err_x)
-#                     delta_y = np.arange(delta_x_y[1]-err_y, delta_x_y[1]+err_y)
-#                     delta_t = np.arange(t-err_theta, t+err_theta)
-#                     for i in delta_t:
-#                         for j in delta_x:
-#                             for k in delta_y:
-#                                 if(len(A) == 0):
-#                                     A.append({
-#                                         'set': [round(j), round(k), i],
-#                                         'count': 1
-#                                     })
-#                                 else:
-#                                     for a in A:
-#                                         if(a['set'] == [round(j), round(k), i]):
-#                                             a['count'] += 1
-#                                             break
-#                                         else:
-#                                             A.append({
-#                                                 'set': [round(j), round(k), i],
-#                                                 'count': 1
-#                                             })
-#                                             break
-
-
-#     max_vote = 0
-#     result_set = []
-#     for a in A:
-#         if(a['count'] > max_vote):
-#             result_set = a['set']
-#             max_vote = a['count']
-
-#     return (result_set, max_vote)
-
-# def rotate_image(mi, delta_x, delta_y, delta_t):
-#     mi_matrix = np.array([[mi[1]], [mi[2]]])
-#     rotation = np.array([[cos(delta_t), sin(delta_t) * (-1)], [sin(delta_t), cos(delta_t)]])
-#     delta_x_y_matrix = np.array([[delta_x], [delta_y]])
-#     result_matrix = rotation.dot(mi_matrix) + delta_x_y_matrix
-#     rel = []
-#     rel.append(mi[0])
-#     rel.append(round(list(result_matrix[0])[0]))
-#     rel.append(round(list(result_matrix[1])[0]))
-#     if(mi[3] + delta_t > 2*pi):
-#         rel.append(mi[3] + delta_t - 2*pi)
-#     else: rel.append(mi[3] + delta_t)
-#     return rel
-
-# def count_minuntiae_matching(I, T, delta_x, delta_y, delta_t, r=10, theta=pi/24):
-#     count = 0
-#     check = np.zeros(len(T))
-#     for mi in I:
-#         for t, mt in enumerate(T):
-#             if(check[t] == 0):
-#                 rotated_minuntiae = rotate_image(mi, delta_x, delta_y, (pi*delta_t)/180)
-#                 (sd, dd) = calculate_distance(rotated_minuntiae, mt)
-#                 if(sd <= r and dd <= theta):
-#                     count += 1
-#                     check[t] = 1
-#     return count
+
+HOUGH_STEP_THETA = 5
+HOUGH_STEP_XY = 8
+HOUGH_MAX_VOTES = 2
+HOUGH_MAX_ROTATION = 90
+HOUGH_MAX_TRANSLATION = 160
+# once aligned, the minutiae of the same finger are much closer than the 50 pixels of the unaligned search
+ALIGNED_DISTANCE_THRESHOLD = 10
+ALIGNED_ANGLE_THRESHOLD = pi/12
+
+
+def hough_transform(I, T, theta=5, step_theta=HOUGH_STEP_THETA, step_xy=HOUGH_STEP_XY, max_votes=HOUGH_MAX_VOTES,
+                    max_rotation=HOUGH_MAX_ROTATION, max_translation=HOUGH_MAX_TRANSLATION):
+    """
+    Rigid transform (rotation about the origin then translation) bringing the probe minutiae I onto the template
+    minutiae T. Every pair of minutiae of the same type votes, in a dense (dtheta, dx, dy) accumulator, for the
+    rotations within theta degrees of the one that aligns their directions and for the translation that then
+    maps the probe minutiae onto the template one. Rotations are taken about the centre of the probe minutiae so
+    that the translations stay within max_translation and the accumulator stays small.
+    :param I: probe, list of [type, x, y, angle] or (m, 4) array
+    :param T: template, list of [type, x, y, angle] or (n, 4) array
+    :param theta: direction tolerance in degrees
+    :param step_theta: rotation bin size in degrees
+    :param step_xy: translation bin size in pixels
+    :param max_votes: votes of a pair, cast in the rotation bins closest to its own rotation
+    :param max_rotation: largest rotation tried, in degrees
+    :param max_translation: largest displacement of the probe centre, in pixels
+    :return: ((delta_x, delta_y, delta_t), votes), delta_t in radians; ((0, 0, 0), 0) without any vote
+    """
+    I = pack_minutiaes(I) if not isinstance(I, np.ndarray) else I
+    T = pack_minutiaes(T) if not isinstance(T, np.ndarray) else T
+    I = I[~np.isnan(I[:, 3])]
+    T = T[~np.isnan(T[:, 3])]
+    step = step_theta * pi / 180
+    half_rotations = min(int(max_rotation // step_theta), (int(round(360 / step_theta)) - 1) // 2)
+    half_translations = int(np.ceil(max_translation / step_xy))
+    shape = (2*half_rotations + 1, 2*half_translations, 2*half_translations)
+
+    # rotation of every pair, and the closest rotation bins compatible with it
+    probe_index, template_index = np.nonzero(I[:, np.newaxis, 0] == T[np.newaxis, :, 0])
+    rotation = np.mod(T[template_index, 3] - I[probe_index, 3] + pi, 2*pi) - pi
+    # bins in order of distance to the rotation: the closest one, then alternately the neighbours on the side the
+    # rotation was rounded from and on the other side (0, +1, -1, +2, ... when it was rounded down)
+    position = rotation / step
+    closest = np.round(position)
+    side = np.where(position < closest, -1, 1)
+    ranks = np.arange(max_votes)
+    offsets = side[:, np.newaxis] * ((ranks + 1) // 2 * np.where(ranks % 2, 1, -1))
+    bins = closest.astype(np.int64)[:, np.newaxis] + offsets
+    valid = (np.abs(bins * step - rotation[:, np.newaxis]) < theta * pi / 180) & (np.abs(bins) <= half_rotations)
+    vote, slot = np.nonzero(valid)
+    bins = bins[vote, slot]
+    angle = bins * step
+    probe_index = probe_index[vote]
+    template_index = template_index[vote]
+
+    centre = I[:, 1:3].mean(axis=0) if len(I) else np.zeros(2)
+    cos_t, sin_t = np.cos(angle), np.sin(angle)
+    x, y = I[probe_index, 1] - centre[0], I[probe_index, 2] - centre[1]
+    shift_x = T[template_index, 1] - centre[0] - (cos_t * x - sin_t * y)
+    shift_y = T[template_index, 2] - centre[1] - (sin_t * x + cos_t * y)
+    bin_x = np.floor(shift_x / step_xy).astype(np.int64) + half_translations
+    bin_y = np.floor(shift_y / step_xy).astype(np.int64) + half_translations
+    cell = ((bins + half_rotations) * shape[1] + bin_x) * shape[2] + bin_y
+    cell[(bin_x < 0) | (bin_x >= shape[1]) | (bin_y < 0) | (bin_y >= shape[2])] = -1
+    if not (cell >= 0).any():
+        return ((0, 0, 0), 0)
+    accumulator = np.bincount(cell[cell >= 0], minlength=shape[0] * shape[1] * shape[2])
+    best = int(np.argmax(accumulator))
+
+    # the winning transform is the mean of the votes of the winning cell, moved back to a rotation about the origin
+    winners = cell == best
+    delta_t = (best // (shape[1] * shape[2]) - half_rotations) * step
+    cos_t, sin_t = cos(delta_t), sin(delta_t)
+    delta_x = shift_x[winners].mean() + centre[0] - (cos_t * centre[0] - sin_t * centre[1])
+    delta_y = shift_y[winners].mean() + centre[1] - (sin_t * centre[0] + cos_t * centre[1])
+    return ((float(delta_x), float(delta_y), float(delta_t % (2*pi))), int(accumulator[best]))
+
+
+def rotate_minutiaes(I, delta_x, delta_y, delta_t):
+    """
+    Apply the transform of hough_transform to the minutiae.
+    :return: (m, 4) array of type, x, y, angle
+    """
+    I = pack_minutiaes(I) if not isinstance(I, np.ndarray) else I
+    cos_t, sin_t = cos(delta_t), sin(delta_t)
+    result = I.copy()
+    result[:, 1] = cos_t * I[:, 1] - sin_t * I[:, 2] + delta_x
+    result[:, 2] = sin_t * I[:, 1] + cos_t * I[:, 2] + delta_y
+    result[:, 3] = np.mod(I[:, 3] + delta_t, 2*pi)
+    return result
+
+
+def count_minuntiae_matching(I, T, delta_x, delta_y, delta_t, r=ALIGNED_DISTANCE_THRESHOLD,
+                             theta=ALIGNED_ANGLE_THRESHOLD):
+    """
+    Number of template minutiae matched by a minutiae of the same type of the transformed probe.
+    """
+    I = rotate_minutiaes(I, delta_x, delta_y, delta_t)
+    T = pack_minutiaes(T) if not isinstance(T, np.ndarray) else T
+    count = 0
+    for minutiae_type in MINUTIAE_TYPES:
+        probe, template = I[I[:, 0] == minutiae_type, 1:], T[T[:, 0] == minutiae_type, 1:]
+        if len(probe) and len(template):
+            count += int(match_matrix(probe, template, r, theta).any(axis=0).sum())
+    return count
+
+
+def aligned_matching(I, T, r=ALIGNED_DISTANCE_THRESHOLD, theta=ALIGNED_ANGLE_THRESHOLD, **kwargs):
+    """
+    Align the probe on the template with hough_transform, then count the matched minutiae.
+    :param kwargs: passed to hough_transform
+    :return: (count, (delta_x, delta_y, delta_t))
+    """
+    I = pack_minutiaes(I) if not isinstance(I, np.ndarray) else I
+    T = pack_minutiaes(T) if not isinstance(T, np.ndarray) else T
+    transform, _ = hough_transform(I, T, **kwargs)
+    return (count_minuntiae_matching(I, T, *transform, r=r, theta=theta), transform)
+
+
+def aligned_scores(I, gallery, indexes=None, **kwargs):
+    """
+    aligned_matching of the probe against the templates of a MinutiaeGallery.
+    :param indexes: templates to score (e.g. TripletIndex.candidates), all of them by default
+    :return: (len(indexes),) int array
+    """
+    I = pack_minutiaes(I) if not isinstance(I, np.ndarray) else I
+    indexes = range(len(gallery)) if indexes is None else indexes
+    return np.array([aligned_matching(I, gallery.template(index), **kwargs)[0] for index in indexes],
+                    dtype=np.int64)
+
 
 # def count_brute_force(I, T, r0, t0):
 #     count = 0
@@ -0,0 +1,149 @@
+"""
+Deployable variants of the CNNnet embedding network (up to fc2) for cpu inference:
+
+    eager       CNNnet.features as trained, float32
+    scripted    BatchNorm folded into the convolutions, TorchScript frozen, float32
+    quantized   scripted with dynamically quantized Linear layers (int8 weights, fc1 is 4096x256)
+
+    python -m model.cnn_export --weights cnnnet.pth --output-dir data/models
+
+writes the scripted and quantized variants (torch.jit.save, loaded by EmbeddingService(scripted = ...)) and
+prints the throughput of every variant and the agreement of their k nearest neighbours with the eager ones.
+"""
+import argparse
+import copy
+import json
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+from data import read_image
+from .embedding_service import load_cnnnet, prepare_images, INPUT_SIZE, BATCH_SIZE
+from .vector_index import VectorIndex, normalize_rows
+
+# conv, batch norm and relu of every convolution block, fused into one convolution
+FUSED_MODULES = [['conv2d%d.0' % block, 'conv2d%d.1' % block, 'conv2d%d.2' % block] for block in range(1, 5)]
+
+
+class CNNFeatures(nn.Module):
+	"""
+	CNNnet.features as forward, the module that is scripted and exported.
+	"""
+	def __init__(self, model):
+		super(CNNFeatures, self).__init__()
+		self.model = model
+
+	def forward(self, x):
+		return self.model.features(x)
+
+
+def fold_batch_norm(model):
+	"""
+	Copy of a CNNnet in evaluation mode with every BatchNorm folded into the weights of its convolution.
+	"""
+	model = copy.deepcopy(model).eval()
+	return torch.ao.quantization.fuse_modules(model, FUSED_MODULES)
+
+
+def quantize_linear(model):
+	"""
+	Copy with dynamically quantized Linear layers: int8 weights, activations quantized on the fly per batch.
+	"""
+	return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype = torch.qint8)
+
+
+def freeze(model):
+	"""
+	TorchScript of CNNFeatures(model), frozen: parameters inlined as constants and the graph optimized.
+	"""
+	return torch.jit.freeze(torch.jit.script(CNNFeatures(model).eval()))
+
+
+def export_variants(weights = None):
+	"""
+	:param weights: CNNnet weights, see load_cnnnet
+	:return: {'eager', 'scripted', 'quantized'} modules mapping (n, 1, 160, 160) images to (n, 64) embeddings
+	"""
+	model = load_cnnnet(weights)
+	folded = fold_batch_norm(model)
+	return {
+		'eager': CNNFeatures(model).eval(),
+		'scripted': freeze(folded),
+		'quantized': freeze(quantize_linear(folded)),
+	}
+
+
+def embed(network, batch, batch_size = BATCH_SIZE):
+	"""
+	:param batch: (n, 1, 160, 160) float32 array
+	:return: (n, 64) unit embeddings
+	"""
+	outputs = []
+	with torch.inference_mode():
+		for begin in range(0, len(batch), batch_size):
+			outputs.append(network(torch.from_numpy(batch[begin:begin + batch_size])).numpy())
+	return normalize_rows(np.concatenate(outputs))
+
+
+def throughput(network, batch, batch_size = BATCH_SIZE, repeat = 3):
+	"""
+	Images per second, best of repeat runs after one warm up run (TorchScript profiles its first calls).
+	"""
+	embed(network, batch[:batch_size], batch_size)
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		embed(network, batch, batch_size)
+		best = min(best, time.perf_counter() - start)
+	return len(batch) / best
+
+
+def knn_agreement(reference, embeddings, k = 5):
+	"""
+	Mean fraction of the k nearest neighbours of every embedding (among the others) shared with the reference.
+	:param reference: (n, d) embeddings of the eager network
+	:param embeddings: (n, d) embeddings of a variant, same images
+	"""
+	k = min(k, len(reference) - 1)
+	def neighbours(vectors):
+		nearest, _ = VectorIndex(vectors).knn(vectors, k + 1)
+		# drop each image itself, found at distance 0
+		return [set([i for i in row.tolist() if i != index][:k]) for index, row in enumerate(nearest)]
+	return float(np.mean([len(a & b) / k for a, b in zip(neighbours(reference), neighbours(embeddings))]))
+
+
+if __name__ == '__main__':
+	from .extraction import TRAIN_PATH
+	parser = argparse.ArgumentParser(description = 'Export CNNnet for cpu inference and compare the variants')
+	parser.add_argument('--weights', help = 'CNNnet state_dict, random weights when missing (timing only)')
+	parser.add_argument('--output-dir', default = './data/models')
+	parser.add_argument('--gallery', default = './data/dataset/db_data.json', help = 'images used for the benchmark')
+	parser.add_argument('--batch-size', type = int, default = BATCH_SIZE)
+	parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads')
+	parser.add_argument('-k', type = int, default = 5)
+	args = parser.parse_args()
+	if args.threads:
+		torch.set_num_threads(args.threads)
+
+	variants = export_variants(args.weights)
+	os.makedirs(args.output_dir, exist_ok = True)
+	for name in ('scripted', 'quantized'):
+		path = os.path.join(args.output_dir, 'cnnnet_%s.pt' % name)
+		torch.jit.save(variants[name], path)
+		print('%s: %s, %.1f KB' % (name, path, os.path.getsize(path) / 1024))
+
+	with open(args.gallery, mode = 'r') as f:
+		data = json.load(f)
+	batch = prepare_images([read_image(TRAIN_PATH + '/' + record['img']) for record in data], INPUT_SIZE)
+	reference = embed(variants['eager'], batch, args.batch_size)
+	print('variant'.ljust(12) + 'images/s'.rjust(10) + 'speedup'.rjust(9) + 'cosine'.rjust(9) +
+		  ('top-%d' % args.k).rjust(8))
+	baseline = None
+	for name, network in variants.items():
+		speed = throughput(network, batch, args.batch_size)
+		baseline = baseline or speed
+		embeddings = embed(network, batch, args.batch_size)
+		cosine = float(np.mean(np.sum(embeddings * reference, axis = 1)))
+		print(name.ljust(12) + ('%.1f' % speed).rjust(10) + ('%.2f' % (speed / baseline)).rjust(9) +
+			  ('%.4f' % cosine).rjust(9) + ('%.3f' % knn_agreement(reference, embeddings, args.k)).rjust(8))
@@ -0,0 +1,132 @@
+"""
+CNN embedding service: the 64-dim bottleneck of CNNnet (output of fc2) as a retrieval feature.
+
+The network is loaded once on the cpu; the gallery images are resized to the 1x160x160 input of CNNnet and run in
+batches under torch.inference_mode, the unit embeddings being written batch after batch into a memory mapped .npy
+matrix. A VectorIndex over that matrix answers k-NN queries with one matrix product, a candidate generator in front
+of the minutiae matcher.
+
+    python -m model.embedding_service --weights cnnnet.pth --output data/dataset/db_cnn.npy [--query image.tif]
+
+The network can also be a TorchScript export of model.cnn_export (BatchNorm folded, int8 Linear layers).
+"""
+import argparse
+import json
+import time
+import cv2 as cv
+import numpy as np
+import torch
+from data import read_image
+from .models_pretrain import CNNnet
+from .vector_index import VectorIndex, normalize_rows
+
+INPUT_SIZE = 160
+EMBEDDING_DIM = 64
+BATCH_SIZE = 64
+
+
+def prepare_images(images, size = INPUT_SIZE):
+	"""
+	Grayscale images resized to the network input, pixel values kept in [0, 255] like image_Dataset.
+	:return: (n, 1, size, size) float32 array
+	"""
+	batch = np.zeros((len(images), 1, size, size), dtype = np.float32)
+	for index, image in enumerate(images):
+		batch[index, 0] = image if image.shape == (size, size) else \
+			cv.resize(image, (size, size), interpolation = cv.INTER_AREA)
+	return batch
+
+
+def load_cnnnet(weights = None):
+	"""
+	CNNnet in evaluation mode (batch norm statistics frozen, dropout off).
+	:param weights: state_dict saved with torch.save, or a checkpoint dict holding it under 'state_dict'
+	"""
+	model = CNNnet()
+	if weights is not None:
+		state = torch.load(weights, map_location = 'cpu')
+		model.load_state_dict(state.get('state_dict', state))
+	return model.eval()
+
+
+class EmbeddingService(object):
+	"""
+	CNNnet loaded once, turning batches of grayscale images into unit embeddings.
+	"""
+	def __init__(self, weights = None, batch_size = BATCH_SIZE, threads = None, scripted = None):
+		"""
+		:param weights: CNNnet weights, see load_cnnnet
+		:param batch_size: images per forward pass
+		:param threads: torch intra-op threads, torch default when None
+		:param scripted: TorchScript file written by model.cnn_export, used instead of CNNnet and weights
+		"""
+		if threads:
+			torch.set_num_threads(threads)
+		self.network = torch.jit.load(scripted, map_location = 'cpu') if scripted else load_cnnnet(weights).features
+		self.batch_size = batch_size
+
+	def embed_batch(self, images):
+		"""
+		:param images: list of at most batch_size grayscale images
+		:return: (n, EMBEDDING_DIM) float32 unit embeddings
+		"""
+		with torch.inference_mode():
+			features = self.network(torch.from_numpy(prepare_images(images)))
+		return normalize_rows(features.numpy())
+
+	def embed(self, images):
+		"""
+		Embeddings of any number of images, batch_size at a time.
+		"""
+		batches = [self.embed_batch(images[begin:begin + self.batch_size])
+				   for begin in range(0, len(images), self.batch_size)]
+		return np.concatenate(batches) if batches else np.zeros((0, EMBEDDING_DIM), dtype = np.float32)
+
+	def build(self, paths, output):
+		"""
+		Embed the image files into a memory mapped .npy matrix, written batch by batch so the gallery never has to
+		fit in memory.
+		:return: VectorIndex over the matrix
+		"""
+		vectors = np.lib.format.open_memmap(output, mode = 'w+', dtype = np.float32,
+											shape = (len(paths), EMBEDDING_DIM))
+		for begin in range(0, len(paths), self.batch_size):
+			batch = paths[begin:begin + self.batch_size]
+			vectors[begin:begin + len(batch)] = self.embed_batch([read_image(path) for path in batch])
+		vectors.flush()
+		del vectors
+		return VectorIndex.load(output)
+
+
+if __name__ == '__main__':
+	from .extraction import TRAIN_PATH
+	parser = argparse.ArgumentParser(description = 'Embed the gallery with CNNnet and query its nearest neighbours')
+	parser.add_argument('--weights', help = 'CNNnet state_dict, random weights when missing (timing only)')
+	parser.add_argument('--scripted', help = 'TorchScript export of model.cnn_export, instead of --weights')
+	parser.add_argument('--gallery', default = './data/dataset/db_data.json')
+	parser.add_argument('--output', default = './data/dataset/db_cnn.npy', help = 'memory mapped embedding matrix')
+	parser.add_argument('--batch-size', type = int, default = BATCH_SIZE)
+	parser.add_argument('--query', nargs = '*', default = [], help = 'images to search')
+	parser.add_argument('-k', type = int, default = 5)
+	args = parser.parse_args()
+
+	with open(args.gallery, mode = 'r') as f:
+		data = json.load(f)
+	service = EmbeddingService(args.weights, args.batch_size, scripted = args.scripted)
+	start = time.time()
+	index = service.build([TRAIN_PATH + '/' + record['img'] for record in data], args.output)
+	index.records = data
+	print('gallery: %d embeddings in %s, %.2f ms per image' % (
+		len(index), args.output, (time.time() - start) / max(len(index), 1) * 1e3))
+
+	if args.query:
+		start = time.time()
+		queries = service.embed([read_image(path) for path in args.query])
+		embedding_time = time.time() - start
+		start = time.time()
+		nearest, similarity = index.knn(queries, args.k)
+		search_time = time.time() - start
+		for path, row, values in zip(args.query, nearest, similarity):
+			print(path + ': ' + ', '.join('%s (%.3f)' % (data[i]['img'], value) for i, value in zip(row, values)))
+		print('per query: embedding %.2f ms, k-NN %.3f ms' % (embedding_time / len(queries) * 1e3,
+															 search_time / len(queries) * 1e3))
@@ -0,0 +1,147 @@
+"""
+Offline enrollment: rebuilds the gallery (db_data.json or a binary store) from the train split.
+
+The images of data/dataset/train/DB* are extracted in a pool of worker processes. The sha1 of every enrolled image
+is kept next to the gallery (<gallery>.sha1.json); in incremental mode only the new images and the images whose
+content changed are extracted again, the changed templates are replaced in place and the new ones appended. Every
+template is stored with the pattern class of its image (model.pattern_class).
+
+    python -m model.enrollment --output data/dataset/db_data.json --workers 4
+    python -m model.enrollment --output data/dataset/db_data.json --incremental
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from data import read_image_rgb
+from .extraction import extract_image_template, split_images, TRAIN_PATH
+from .pattern_class import classify_orientation, orientation_field, PATTERN_CLASSES
+from .template_store import TemplateStore, write_template_store
+
+GALLERY_PATH = './data/dataset/db_data.json'
+CHUNK_SIZE = 4
+
+
+def file_hash(path):
+	"""
+	sha1 hex digest of the file content.
+	"""
+	digest = hashlib.sha1()
+	with open(path, mode = 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def manifest_path(path):
+	return path + '.sha1.json'
+
+
+def read_records(path):
+	"""
+	db_data.json records of a gallery file (JSON or binary store), an empty list when it does not exist yet.
+	"""
+	if not os.path.exists(path):
+		return []
+	if path.endswith('.json'):
+		with open(path, mode = 'r') as f:
+			return json.load(f)
+	return TemplateStore(path).records()
+
+
+def _write_json(path, data):
+	tmp_path = path + '.tmp'
+	with open(tmp_path, mode = 'w') as f:
+		json.dump(data, f)
+	os.replace(tmp_path, path)
+
+
+def write_records(path, data):
+	"""
+	Write the records as JSON or binary store depending on the extension; the file is written next to path and
+	renamed, so a reader (or an interrupted enrollment) never sees a partially written gallery.
+	"""
+	if path.endswith('.json'):
+		_write_json(path, data)
+	else:
+		write_template_store(path, data)
+
+
+def _extract(root, image_id, template = True):
+	image = read_image_rgb(os.path.join(root, image_id))
+	if template:
+		# the class comes from the orientation field the extractor already computed
+		points, angles, mask = extract_image_template(image, return_orientation = True)
+	else:
+		points, (angles, mask) = None, orientation_field(image)
+	return image_id, points, PATTERN_CLASSES[classify_orientation(angles, mask)]
+
+
+def enroll(root = TRAIN_PATH, output = GALLERY_PATH, workers = None, incremental = False, chunk_size = CHUNK_SIZE):
+	"""
+	:param root: train split, with one directory per database (DB1, DB2, ...)
+	:param output: gallery file, .json or binary store
+	:param workers: number of extraction processes, os.cpu_count() by default
+	:param incremental: keep the templates of the images whose content did not change since the last enrollment
+						(only classified when enrolled before the classes were stored); images removed from root
+						keep their template
+	:return: {'images', 'extracted', 'kept', 'templates', 'seconds'}
+	"""
+	start = time.time()
+	images = split_images(root)
+	hashes = {image_id: file_hash(os.path.join(root, image_id)) for image_id in images}
+	data, manifest = [], {}
+	if incremental:
+		data = read_records(output)
+		if os.path.exists(manifest_path(output)):
+			with open(manifest_path(output), mode = 'r') as f:
+				manifest = json.load(f)
+	position = {record['img']: index for index, record in enumerate(data)}
+	todo = [image_id for image_id in images if image_id not in position or manifest.get(image_id) != hashes[image_id]]
+	changed = set(todo)
+	unclassified = [image_id for image_id in images if image_id in position and image_id not in changed and
+					'class' not in data[position[image_id]]]
+	jobs = todo + unclassified
+	templates = [True] * len(todo) + [False] * len(unclassified)
+
+	workers = workers or os.cpu_count() or 1
+	if workers == 1:
+		results = map(_extract, repeat(root), jobs, templates)
+	else:
+		pool = ProcessPoolExecutor(max_workers = workers)
+		results = pool.map(_extract, repeat(root), jobs, templates, chunksize = chunk_size)
+	try:
+		for image_id, points, pattern in results:
+			if image_id not in position:
+				position[image_id] = len(data)
+				data.append({'img': image_id})
+			record = data[position[image_id]]
+			if points is not None:
+				record['points'] = points
+			record['class'] = pattern
+			manifest[image_id] = hashes[image_id]
+	finally:
+		if workers != 1:
+			pool.shutdown()
+
+	write_records(output, data)
+	_write_json(manifest_path(output), manifest)
+	return {'images': len(images), 'extracted': len(todo), 'kept': len(images) - len(todo), 'templates': len(data),
+			'seconds': round(time.time() - start, 2)}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Build the gallery from the images of the train split')
+	parser.add_argument('--train', default = TRAIN_PATH, help = 'directory holding DB1, DB2, ...')
+	parser.add_argument('--output', default = GALLERY_PATH, help = '.json or binary store (e.g. db_data.bin)')
+	parser.add_argument('--workers', type = int, default = None, help = 'extraction processes, one per cpu by default')
+	parser.add_argument('--incremental', action = 'store_true',
+						help = 'only extract the images that are new or changed since the last enrollment')
+	parser.add_argument('--chunk-size', type = int, default = CHUNK_SIZE)
+	args = parser.parse_args()
+	summary = enroll(args.train, args.output, args.workers, args.incremental, args.chunk_size)
+	print('%(images)d images: %(extracted)d extracted, %(kept)d kept, %(templates)d templates in the gallery, '
+		  '%(seconds).2fs' % summary)
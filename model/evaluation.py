@@ -0,0 +1,176 @@
+"""
+Identification accuracy and latency on the test split (DB1-DB4), the replacement of the result.txt loop of pipline.
+
+Every test image goes through extraction and identification in a pool of worker processes, each worker loading the
+gallery once. The databases are evaluated one after the other so that their throughput is measured on their own.
+
+    python -m model.evaluation --workers 4 --output data/dataset/evaluation.json
+
+prints rank-1 / rank-k hit rates, latency percentiles of every stage and throughput per database, and writes them
+with the result of every image as JSON. A hit is a template of the probe finger (extraction.same_finger).
+With --check the scan method also runs the exhaustive MinutiaeGallery.search and reports the images whose top k
+differs from the pruned identify.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from data import read_image_rgb
+from .extraction import extract_image_template, split_images, same_finger, TEST_PATH
+from .identification import IdentificationService, GALLERY_PATHS, CANDIDATES
+
+METHODS = ('aligned', 'scan')
+RANKS = (1, 5, 10)
+PERCENTILES = (50, 90, 99)
+
+_worker = {}
+
+
+def _milliseconds(start):
+	return (time.perf_counter() - start) * 1000
+
+
+def _init_worker(gallery_path, method, candidates, check = False):
+	_worker['method'] = method
+	_worker['check'] = check
+	_worker['service'] = IdentificationService(gallery_path, candidates)
+
+
+def _scan(image, k):
+	"""
+	Full scan of the gallery with the unaligned matcher, the rule of pipline.search_image.
+	:return: (image ids of the top k, timings, whether the top k is the one of the exhaustive search, None unchecked)
+	"""
+	service = _worker['service']
+	timings = {}
+	start = total = time.perf_counter()
+	probe = extract_image_template(image)
+	timings['extraction'] = _milliseconds(start)
+	start = time.perf_counter()
+	results, _ = service.gallery.identify(probe, k)
+	timings['matching'] = _milliseconds(start)
+	timings['total'] = _milliseconds(total)
+	consistent = results == service.gallery.search(probe, k) if _worker['check'] else None
+	return [service.image_ids[index] for index, _ in results], timings, consistent
+
+
+def evaluate_image(test_path, image_id, k):
+	"""
+	Identify one test image in the worker gallery.
+	:return: {'img', 'rank' (1 based, None when no template of the finger is in the top k), 'matches', 'timings'},
+			 and 'consistent' (top k of identify equal to the one of search) when the scan is checked
+	"""
+	image = read_image_rgb(os.path.join(test_path, image_id))
+	consistent = None
+	if _worker['method'] == 'scan':
+		matches, timings, consistent = _scan(image, k)
+	else:
+		result = _worker['service'].identify(image, k)
+		matches, timings = [match['img'] for match in result['matches']], result['timings']
+	rank = next((position + 1 for position, match in enumerate(matches) if same_finger(image_id, match)), None)
+	result = {'img': image_id, 'rank': rank, 'matches': matches, 'timings': timings}
+	if consistent is not None:
+		result['consistent'] = consistent
+	return result
+
+
+def summarize(results, seconds, ranks = RANKS, percentiles = PERCENTILES):
+	"""
+	:param results: evaluate_image results
+	:param seconds: wall clock time taken by the results
+	:return: {'images', 'rank-n' hit rates, 'latency': {stage: {'mean', 'p50', ...} in ms}, 'images_per_second'}
+	"""
+	summary = {'images': len(results)}
+	for n in ranks:
+		summary['rank-%d' % n] = float(np.mean([result['rank'] is not None and result['rank'] <= n
+												for result in results])) if results else 0.
+	summary['latency'] = {}
+	for stage in (results[0]['timings'] if results else {}):
+		values = np.array([result['timings'][stage] for result in results])
+		summary['latency'][stage] = dict([('mean', round(float(values.mean()), 2))] +
+										 [('p%d' % p, round(float(np.percentile(values, p)), 2)) for p in percentiles])
+	summary['seconds'] = round(seconds, 3)
+	summary['images_per_second'] = round(len(results) / seconds, 2) if seconds > 0 else 0.
+	return summary
+
+
+def evaluate(test_path = TEST_PATH, gallery_path = None, method = 'aligned', workers = None, ranks = RANKS,
+			 candidates = CANDIDATES, check = False):
+	"""
+	:param gallery_path: binary store or db_data.json, the first existing one of GALLERY_PATHS by default
+	:param method: 'aligned' (triplet index candidates scored after Hough alignment, the /api/identify path) or
+				   'scan' (every template scored by the unaligned matcher)
+	:param workers: number of processes, os.cpu_count() by default
+	:param check: scan only, compare the top k of every image with the exhaustive search (not timed apart)
+	:return: {'config', 'databases': {database: summary}, 'all': summary, 'results': per image results}, and
+			 'inconsistent' (images whose top k differs from the exhaustive search) when checked
+	"""
+	if gallery_path is None:
+		gallery_path = next((path for path in GALLERY_PATHS if os.path.exists(path)), GALLERY_PATHS[-1])
+	workers = workers or os.cpu_count() or 1
+	k = max(ranks)
+	images = split_images(test_path)
+	databases = sorted(set(image.split('/')[0] for image in images))
+	report = {'config': {'test': test_path, 'gallery': gallery_path, 'method': method, 'workers': workers, 'k': k,
+						 'candidates': candidates},
+			  'databases': {}, 'results': []}
+	with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+							 initargs = (gallery_path, method, candidates, check)) as pool:
+		# start the workers (gallery loading) before the clock
+		list(pool.map(len, [()] * workers))
+		for database in databases:
+			selected = [image for image in images if image.split('/')[0] == database]
+			start = time.perf_counter()
+			results = list(pool.map(evaluate_image, [test_path] * len(selected), selected, [k] * len(selected)))
+			report['databases'][database] = summarize(results, time.perf_counter() - start, ranks)
+			report['results'].extend(results)
+	report['all'] = summarize(report['results'], sum(summary['seconds'] for summary in report['databases'].values()),
+							  ranks)
+	if check and method == 'scan':
+		report['inconsistent'] = [result['img'] for result in report['results'] if not result['consistent']]
+	return report
+
+
+def format_report(report):
+	"""
+	Text table of the summaries of a report.
+	"""
+	summaries = list(report['databases'].items()) + [('all', report['all'])]
+	ranks = [key for key in report['all'] if key.startswith('rank-')]
+	stages = list(report['all']['latency'])
+	header = 'database'.ljust(10) + 'images'.rjust(7) + ''.join(rank.rjust(9) for rank in ranks) + \
+		''.join(('%s p50/p90/p99 ms' % stage).rjust(30) for stage in stages) + 'images/s'.rjust(10)
+	lines = [header]
+	for name, summary in summaries:
+		latency = ''.join(('%.1f / %.1f / %.1f' % tuple(summary['latency'][stage]['p%d' % p] for p in PERCENTILES))
+						  .rjust(30) for stage in stages)
+		lines.append(name.ljust(10) + str(summary['images']).rjust(7) +
+					 ''.join(('%.3f' % summary[rank]).rjust(9) for rank in ranks) + latency +
+					 ('%.2f' % summary['images_per_second']).rjust(10))
+	return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Identification accuracy and latency on the test split')
+	parser.add_argument('--test', default = TEST_PATH, help = 'directory holding DB1, DB2, ...')
+	parser.add_argument('--gallery', default = None, help = 'binary store or db_data.json')
+	parser.add_argument('--method', choices = METHODS, default = 'aligned')
+	parser.add_argument('--workers', type = int, default = None, help = 'processes, one per cpu by default')
+	parser.add_argument('--ranks', type = int, nargs = '+', default = list(RANKS))
+	parser.add_argument('--candidates', type = int, default = CANDIDATES, help = 'triplet index candidates (aligned)')
+	parser.add_argument('--output', default = None, help = 'JSON report')
+	parser.add_argument('--check', action = 'store_true', help = 'scan: compare identify with the exhaustive search')
+	args = parser.parse_args()
+
+	report = evaluate(args.test, args.gallery, args.method, args.workers, args.ranks, args.candidates, args.check)
+	print(format_report(report))
+	if 'inconsistent' in report:
+		print('top-%d differing from the exhaustive search: %d / %d images %s' % (
+			report['config']['k'], len(report['inconsistent']), report['all']['images'],
+			' '.join(report['inconsistent'])))
+	if args.output:
+		with open(args.output, mode = 'w') as f:
+			json.dump(report, f, indent = 2)
+		print('report written to %s' % args.output)
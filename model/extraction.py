@@ -0,0 +1,60 @@
+"""
+Minutiae template of one image file, the chain of pipline.main, and helpers to walk the dataset splits.
+"""
+import glob
+import os
+from data import read_image_rgb, normalize, create_segmented_and_variance_images, calculate_angles, ridge_freq, \
+	gabor_filter
+from .thinning import skeletonize
+from .minunate_detection import get_minunatiaes_point
+
+TEST_PATH = './data/dataset/test'
+TRAIN_PATH = './data/dataset/train'
+
+
+def extract_template(path, w = 16):
+	"""
+	Minutiae of the image file as stored in db_data.json.
+	:return: list of [type, x, y, angle]
+	"""
+	return extract_image_template(read_image_rgb(path), w)
+
+
+def extract_image_template(image, w = 16, return_orientation = False):
+	"""
+	extract_template of a grayscale image already in memory (e.g. an uploaded file decoded with cv.imdecode).
+	:param return_orientation: also return the block orientation field and the segmentation mask computed on the
+							   way (the orientation_field of model.pattern_class), as (template, angles, mask)
+	"""
+	image = normalize(image, m0 = float(100), v0 = float(100))
+	image_segment, norm_img, mask = create_segmented_and_variance_images(image, w = w, threshold = .4)
+	image_oriented = calculate_angles(image_segment, w)
+	freq = ridge_freq(norm_img, mask, image_oriented, w, kernel_size = 5, minWaveLength = 5, maxWaveLength = 15)
+	gabor_img = gabor_filter(norm_img, image_oriented, freq)
+	image_thinning = skeletonize(gabor_img)
+	list_point_minunate, _ = get_minunatiaes_point(image_thinning)
+	template = [[i[0], i[1][0], i[1][1], i[2]] for i in list_point_minunate]
+	return (template, image_oriented, mask) if return_orientation else template
+
+
+def split_images(root = TEST_PATH):
+	"""
+	Images of a dataset split, as 'DB<i>/<finger>_<impression>.tif' paths relative to root, sorted.
+	"""
+	paths = glob.glob(os.path.join(root, 'DB*', '*.tif'))
+	return sorted(os.path.relpath(path, root).replace(os.sep, '/') for path in paths)
+
+
+def finger_id(image_id):
+	"""
+	'DB1/101_3.tif' -> 'DB1/101', the key shared by every impression of a finger.
+	"""
+	database, name = image_id.replace('\\', '/').split('/')[-2:]
+	return database + '/' + name.split('_')[0]
+
+
+def same_finger(source, rel):
+	"""
+	Same test as pipline.path_tokenizer: both images are impressions of the same finger of the same database.
+	"""
+	return finger_id(source) == finger_id(rel)
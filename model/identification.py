@@ -0,0 +1,136 @@
+"""
+Identification and verification service for the web servers: the gallery, its triplet index and the image ids are
+loaded once and kept in memory, every request only extracts the probe minutiae and matches them.
+
+Identification votes for candidates in the TripletIndex, aligns the probe on each of them (hough_transform) and
+ranks them by matched minutiae; verification aligns the probe on the templates of the claimed finger.
+"""
+import os
+import re
+import time
+import numpy as np
+from .triplet_index import TripletIndex
+from .calculate_distance import aligned_scores
+from .template_store import open_gallery
+from .extraction import extract_image_template, finger_id
+
+GALLERY_PATHS = ('./data/dataset/db_data.bin', './data/dataset/db_data.json')
+CANDIDATES = 50
+TOP_K = 5
+# aligned matched minutiae; about 0.1% false accepts between the test and train fingers of DB1-DB4
+VERIFY_THRESHOLD = 10
+# parts of a claim: the database directory and the finger number of the image names (DB1/101_1.tif)
+DATABASE_ID = re.compile(r'^DB\d+$')
+FINGER_NUMBER = re.compile(r'^\d+$')
+
+
+def _milliseconds(start):
+	return round((time.perf_counter() - start) * 1000, 2)
+
+
+def claim_finger(claim):
+	"""
+	Finger id of a verification claim, None when the claim is neither an image id ('DB1/101_1.tif') nor a finger
+	id ('DB1/101').
+	"""
+	parts = claim.replace('\\', '/').split('/')
+	if len(parts) < 2 or not DATABASE_ID.match(parts[-2]) or not FINGER_NUMBER.match(parts[-1].split('_')[0]):
+		return None
+	return finger_id(claim if '_' in parts[-1] else claim + '_')
+
+
+def parse_top_k(value, default = TOP_K):
+	"""
+	Number of matches asked by a request (a form field), default when missing, None when not a positive integer.
+	"""
+	if value is None or value == '':
+		return default
+	try:
+		k = int(value)
+	except (TypeError, ValueError):
+		return None
+	return k if k > 0 else None
+
+
+class IdentificationService(object):
+	def __init__(self, path = None, candidates = CANDIDATES):
+		"""
+		:param path: binary store or db_data.json, the first existing one of GALLERY_PATHS by default
+		:param candidates: templates passed from the triplet index to the aligned matcher
+		"""
+		start = time.perf_counter()
+		if path is None:
+			path = next((path for path in GALLERY_PATHS if os.path.exists(path)), GALLERY_PATHS[-1])
+		self.path = path
+		self.gallery = open_gallery(path)
+		records = self.gallery.records
+		self.image_ids = [records.image_id(index) if hasattr(records, 'image_id') else records[index]['img']
+						  for index in range(len(self.gallery))]
+		self.fingers = np.array([finger_id(image_id) for image_id in self.image_ids])
+		self.index = TripletIndex.from_templates([self.gallery.template(index) for index in range(len(self.gallery))])
+		self.candidates = candidates
+		self.load_time = _milliseconds(start)
+
+	def __len__(self):
+		return len(self.gallery)
+
+	def identify(self, image, k = TOP_K):
+		"""
+		:param image: grayscale image
+		:return: {'matches': [{'rank', 'index', 'img', 'score'}], 'minutiae', 'timings': milliseconds per stage}
+		"""
+		timings = {}
+		start = total = time.perf_counter()
+		probe = extract_image_template(image)
+		timings['extraction'] = _milliseconds(start)
+
+		start = time.perf_counter()
+		candidates = self.index.candidates(probe, min(self.candidates, len(self)))
+		timings['candidates'] = _milliseconds(start)
+
+		start = time.perf_counter()
+		scores = aligned_scores(probe, self.gallery, candidates)
+		order = np.argsort(-scores, kind = 'stable')[:k]
+		timings['matching'] = _milliseconds(start)
+		timings['total'] = _milliseconds(total)
+
+		matches = [{'rank': rank + 1, 'index': int(candidates[i]), 'img': self.image_ids[candidates[i]],
+					'score': int(scores[i])} for rank, i in enumerate(order)]
+		return {'matches': matches, 'minutiae': len(probe), 'candidates': len(candidates), 'timings': timings}
+
+	def verify(self, image, claim, threshold = VERIFY_THRESHOLD):
+		"""
+		:param claim: image id of a gallery template ('DB1/101_1.tif') or finger id ('DB1/101'); the probe is
+					  compared with every template of that finger
+		:return: {'claim', 'match', 'score', 'best', 'threshold', 'minutiae', 'timings'}, None for an unknown claim
+		:raises ValueError: malformed claim (see claim_finger)
+		"""
+		finger = claim_finger(claim)
+		if finger is None:
+			raise ValueError('invalid claim %r, expected a finger id like DB1/101' % claim)
+		claimed = np.flatnonzero(self.fingers == finger)
+		if len(claimed) == 0:
+			return None
+		timings = {}
+		start = total = time.perf_counter()
+		probe = extract_image_template(image)
+		timings['extraction'] = _milliseconds(start)
+
+		start = time.perf_counter()
+		scores = aligned_scores(probe, self.gallery, claimed)
+		timings['matching'] = _milliseconds(start)
+		timings['total'] = _milliseconds(total)
+
+		best = int(np.argmax(scores))
+		return {'claim': claim, 'match': bool(scores[best] >= threshold), 'score': int(scores[best]),
+				'best': self.image_ids[claimed[best]], 'threshold': threshold, 'minutiae': len(probe),
+				'timings': timings}
+
+
+if __name__ == '__main__':
+	# python -m model.identification: claims accepted by claim_finger, the rest is a 400 of /api/verify
+	for claim, expected in (('DB1/101', 'DB1/101'), ('DB1/101_1.tif', 'DB1/101'), ('DB4\\110_2.tif', 'DB4/110'),
+							('101', None), ('/', None), ('foo/101', None), ('x/y', None), ('DB1/', None),
+							('DB1/abc', None)):
+		found = claim_finger(claim)
+		print('%-16s %-10s %s' % (claim, found, 'ok' if found == expected else 'expected %s' % expected))
@@ -0,0 +1,418 @@
+"""
+Vectorized 1:N minutiae matching. Every gallery template is packed into contiguous NumPy arrays split by
+minutiae type, so a probe is scored against a whole block of templates with broadcasted distance and
+angle difference matrices instead of a Python loop over every pair of minutiae.
+
+Two minutiae match when they have the same type, sd < 50 and dd < pi/24 (see calculate_distance).
+The minutiae of every template are indexed by a uniform grid of GRID_CELL_SIZE cells built at enrollment, so a
+probe minutiae is only compared with the template minutiae of the cells around it.
+"""
+import heapq
+import json
+from math import pi
+import numpy as np
+
+DISTANCE_THRESHOLD = 50
+ANGLE_THRESHOLD = pi/24
+MINUTIAE_TYPES = (0, 1)
+
+# Uniform grid over (x, y) used to only pair minutiae of neighbouring cells. Cell keys are
+# column * _CELL_STRIDE + row with a bias so that negative (aligned) coordinates keep a valid key.
+GRID_CELL_SIZE = 50
+_CELL_STRIDE = 1 << 16
+_CELL_BIAS = 1 << 15
+_TEMPLATE_STRIDE = _CELL_STRIDE * _CELL_STRIDE
+
+
+def pack_minutiaes(points):
+	"""
+	List of [type, x, y, angle] minutiae to a (n, 4) float64 array, None angles becoming NaN (never match).
+	"""
+	packed = np.array([[np.nan if value is None else value for value in point] for point in points],
+					  dtype = np.float64).reshape(-1, 4)
+	return packed
+
+
+def match_pairs(probe, gallery, r0 = DISTANCE_THRESHOLD, t0 = ANGLE_THRESHOLD):
+	"""
+	Same test as match_matrix for aligned (m, 3) probe and gallery arrays.
+	:return: (m,) bool array
+	"""
+	dx = gallery[:, 0] - probe[:, 0]
+	dy = gallery[:, 1] - probe[:, 1]
+	sd = np.sqrt(dx*dx + dy*dy)
+	angle_diff = np.abs(gallery[:, 2] - probe[:, 2])
+	dd = np.minimum(angle_diff, 2*pi - angle_diff)
+	return (sd < r0) & (dd < t0)
+
+
+def match_matrix(probe, gallery, r0 = DISTANCE_THRESHOLD, t0 = ANGLE_THRESHOLD):
+	"""
+	Compatibility of every probe minutiae with every gallery minutiae of the same type.
+	:param probe: (m, 3) array of x, y, angle
+	:param gallery: (n, 3) array of x, y, angle
+	:return: (m, n) bool array
+	"""
+	dx = gallery[np.newaxis, :, 0] - probe[:, np.newaxis, 0]
+	dy = gallery[np.newaxis, :, 1] - probe[:, np.newaxis, 1]
+	sd = np.sqrt(dx*dx + dy*dy)
+	angle_diff = np.abs(gallery[np.newaxis, :, 2] - probe[:, np.newaxis, 2])
+	dd = np.minimum(angle_diff, 2*pi - angle_diff)
+	return (sd < r0) & (dd < t0)
+
+
+def grid_cells(xy, cell_size = GRID_CELL_SIZE):
+	"""
+	Cell coordinates of (n, 2) x, y points in the uniform grid.
+	:return: (cell_x, cell_y) int64 arrays
+	"""
+	cells = np.floor(np.asarray(xy, dtype = np.float64) / cell_size).astype(np.int64) + _CELL_BIAS
+	return cells[:, 0], cells[:, 1]
+
+
+def grid_keys(xy, cell_size = GRID_CELL_SIZE):
+	"""
+	Sortable cell key of every point; the keys of cells (cx, cy - 1), (cx, cy), (cx, cy + 1) are consecutive.
+	"""
+	cell_x, cell_y = grid_cells(xy, cell_size)
+	return cell_x * _CELL_STRIDE + cell_y
+
+
+def grid_pairs(probe, index, templates, cell_size, r0):
+	"""
+	Candidate pairs (probe minutiae, gallery row) of the probe minutiae with the gallery minutiae lying in the
+	cells around them, using the per template grid index.
+	:param probe: (m, 3) array of x, y, angle
+	:param index: (n,) template_grid_keys of the rows, ascending
+	:param templates: template indexes to pair with
+	:param cell_size: cell size the keys were built with
+	:param r0: pairing radius, the number of neighbouring cells looked at grows with r0 / cell_size
+	:return: (probe_index, row) int arrays
+	"""
+	reach = int(np.ceil(r0 / cell_size))
+	# sorted probe keys give sorted queries, which searchsorted answers faster
+	probe_order = np.argsort(grid_keys(probe[:, :2], cell_size), kind = 'stable')
+	cell_x, cell_y = grid_cells(probe[probe_order, :2], cell_size)
+	template_keys = np.asarray(templates, dtype = np.int64)[:, np.newaxis] * _TEMPLATE_STRIDE
+
+	begin, end = [], []
+	for dx in range(-reach, reach + 1):
+		column = template_keys + (cell_x + dx) * _CELL_STRIDE + cell_y
+		begin.append(np.searchsorted(index, column - reach, side = 'left'))
+		end.append(np.searchsorted(index, column + reach, side = 'right'))
+	begin = np.stack(begin, axis = -1).ravel(); end = np.stack(end, axis = -1).ravel()
+	probe_index = np.broadcast_to(probe_order[:, np.newaxis], (len(templates), len(probe), 2*reach + 1)).ravel()
+
+	# expand the [begin, end) ranges into one entry per pair
+	lengths = end - begin
+	nonempty = lengths > 0
+	begin = begin[nonempty]; lengths = lengths[nonempty]; probe_index = probe_index[nonempty]
+	starts = np.repeat(begin - (np.cumsum(lengths) - lengths), lengths)
+	return np.repeat(probe_index, lengths), starts + np.arange(len(starts))
+
+
+def template_grid_keys(owner, keys):
+	"""
+	Grid index of packed templates: one sortable key per (template, cell), ascending over a gallery whose
+	rows are grouped by template and sorted by cell inside every template.
+	"""
+	return np.asarray(owner, dtype = np.int64) * _TEMPLATE_STRIDE + keys
+
+
+def greedy_assignment(compatible, owner):
+	"""
+	One to one pairing: probe minutiae are taken in order and each one claims, in every template, the first
+	compatible gallery minutiae not claimed yet.
+	:param compatible: (m, n) bool array from match_matrix
+	:param owner: (n,) template index of every gallery minutiae
+	:return: (n,) bool array of the claimed gallery minutiae
+	"""
+	probe_index, rows = np.nonzero(compatible)
+	return greedy_pair_assignment(probe_index, rows, owner, compatible.shape[1])
+
+
+def greedy_pair_assignment(probe_index, rows, owner, n_rows):
+	"""
+	greedy_assignment for compatible pairs given as (probe minutiae, gallery row) arrays.
+	The sequential greedy accepts the pairs in (probe minutiae, row) order when neither the probe minutiae (in the
+	template of the row) nor the row is taken yet. Instead of walking the probe minutiae, every round accepts at
+	once the pairs that come first among the remaining pairs of both their probe minutiae and their row (they are
+	accepted by the sequential greedy too), then drops the pairs touching them; the first remaining pair is always
+	accepted, and few rounds are needed in practice.
+	:return: (n_rows,) bool array of the claimed gallery rows
+	"""
+	claimed = np.zeros(n_rows, dtype = bool)
+	order = np.lexsort((rows, probe_index))
+	rows = np.asarray(rows, dtype = np.int64)[order]
+	owner = np.asarray(owner, dtype = np.int64)
+	# one key per (probe minutiae, template): a probe minutiae is paired once in every template
+	keys = np.asarray(probe_index, dtype = np.int64)[order] * (int(owner.max()) + 1 if len(owner) else 1) + owner[rows]
+	while len(rows):
+		first = np.zeros(len(rows), dtype = bool)
+		first[np.unique(keys, return_index = True)[1]] = True
+		accepted = np.zeros(len(rows), dtype = bool)
+		accepted[np.unique(rows, return_index = True)[1]] = True
+		accepted &= first
+		claimed[rows[accepted]] = True
+		remaining = ~claimed[rows] & ~np.isin(keys, keys[accepted])
+		rows = rows[remaining]; keys = keys[remaining]
+	return claimed
+
+
+def bounded_top_k(bounds, score, k = 1, order = None, batch_size = 64):
+	"""
+	Top k templates kept in a heap while templates whose upper bound cannot enter it any more are skipped.
+	:param bounds: (n,) upper bound of the score of every template
+	:param score: function scoring an array of template indexes, returns their scores
+	:param order: visiting order, bounds descending by default so that the heap fills with strong candidates
+				  and the loop stops at the first template that cannot enter it
+	:param batch_size: number of templates scored at once
+	:return: (list of (template index, score) best first with ties broken by template index, number of pruned
+			  templates)
+	"""
+	bounds = np.asarray(bounds)
+	sorted_order = order is None
+	order = np.argsort(-bounds, kind = 'stable') if sorted_order else np.asarray(order, dtype = np.int64)
+	heap = []
+	pruned = 0
+	position = 0
+	while position < len(order):
+		batch = order[position:position + batch_size]
+		position += len(batch)
+		last = False
+		if len(heap) == k:
+			# (bound, -index) is the best key a template can reach, the heap holds the k best (score, -index)
+			worst_score, worst_index = heap[0]
+			enters = (bounds[batch] > worst_score) | ((bounds[batch] == worst_score) & (-batch > worst_index))
+			pruned += int(np.count_nonzero(~enters))
+			batch = batch[enters]
+			# in bounds order no template after the first one that cannot enter can enter either
+			last = sorted_order and len(batch) < len(enters)
+			if last:
+				pruned += len(order) - position
+		if len(batch):
+			for index, value in zip(batch.tolist(), np.asarray(score(batch)).tolist()):
+				if len(heap) < k:
+					heapq.heappush(heap, (value, -index))
+				elif (value, -index) > heap[0]:
+					heapq.heapreplace(heap, (value, -index))
+		if last:
+			break
+	return [(-index, value) for value, index in sorted(heap, reverse = True)], pruned
+
+
+class MinutiaeGallery(object):
+	"""
+	Gallery of minutiae templates packed by minutiae type: for each type one (n, 3) array of x, y, angle over
+	all templates, the template index of every row and the offsets of every template in it.
+	"""
+	def __init__(self, points, owner, offsets, records, cells = None, cell_size = GRID_CELL_SIZE):
+		"""
+		:param points: {type: (n, 3) array of x, y, angle}, rows grouped by template
+		:param owner: {type: (n,) template index of every row}
+		:param offsets: {type: (n_templates + 1,) first row of every template}
+		:param records: sequence with one object per template (e.g. the db_data.json entry)
+		:param cells: {type: (n,) template_grid_keys of every row}, the spatial grid index of the templates; the
+					  rows of every template must then be sorted by cell. None disables grid pairing.
+		:param cell_size: cell size of the grid index
+		"""
+		self.points = points
+		self.owner = owner
+		self.offsets = offsets
+		self.records = records
+		self.cells = cells
+		self.cell_size = cell_size
+
+	@classmethod
+	def from_templates(cls, templates, records = None, cell_size = GRID_CELL_SIZE):
+		"""
+		Pack the templates and build their grid index: the minutiae of every template are sorted by cell.
+		:param templates: list of templates, each one a list of [type, x, y, angle]
+		:param records: optional object kept for every template, the template index by default
+		"""
+		packed = [pack_minutiaes(points) for points in templates]
+		counts = [len(template) for template in packed]
+		minutiaes = np.concatenate(packed) if packed else np.zeros((0, 4))
+		return cls.from_arrays(minutiaes, np.repeat(np.arange(len(templates)), counts), len(templates), records,
+							   cell_size)
+
+	@classmethod
+	def from_arrays(cls, minutiaes, owner, n_templates, records = None, cell_size = GRID_CELL_SIZE):
+		"""
+		:param minutiaes: (n, 4) array of type, x, y, angle of all templates
+		:param owner: (n,) ascending template index of every minutiae
+		"""
+		records = records if records is not None else list(range(n_templates))
+		points, owners, offsets, cells = {}, {}, {}, {}
+		for minutiae_type in MINUTIAE_TYPES:
+			rows = minutiaes[:, 0] == minutiae_type
+			owners[minutiae_type] = np.asarray(owner, dtype = np.int64)[rows]
+			offsets[minutiae_type] = np.searchsorted(owners[minutiae_type], np.arange(n_templates + 1)).astype(np.int64)
+			index = template_grid_keys(owners[minutiae_type], grid_keys(minutiaes[rows, 1:3], cell_size))
+			order = np.argsort(index, kind = 'stable')
+			points[minutiae_type] = np.ascontiguousarray(minutiaes[rows, 1:][order], dtype = np.float64)
+			cells[minutiae_type] = index[order]
+		return cls(points, owners, offsets, records, cells, cell_size)
+
+	@classmethod
+	def from_records(cls, data):
+		"""
+		Gallery from the list of {'img': ..., 'points': [[type, x, y, angle], ...]} stored in db_data.json.
+		"""
+		return cls.from_templates([record['points'] for record in data], records = data)
+
+	@classmethod
+	def from_json(cls, path):
+		with open(path, mode = 'r') as f:
+			return cls.from_records(json.load(f))
+
+	def __len__(self):
+		return len(self.records)
+
+	def template(self, index):
+		"""
+		Minutiae of one template as a (n, 4) array of type, x, y, angle, grouped by type.
+		"""
+		return np.concatenate([np.column_stack([np.full(self.offsets[t][index + 1] - self.offsets[t][index], t),
+												self.points[t][self.offsets[t][index]:self.offsets[t][index + 1]]])
+							   for t in MINUTIAE_TYPES]).astype(np.float64)
+
+	def subset(self, indexes):
+		"""
+		Gallery of the given templates only, in that order (a copy).
+		"""
+		indexes = np.asarray(indexes, dtype = np.int64)
+		points, owner, offsets, cells = {}, {}, {}, {}
+		for minutiae_type in MINUTIAE_TYPES:
+			begin = self.offsets[minutiae_type][indexes]
+			counts = self.offsets[minutiae_type][indexes + 1] - begin
+			rows = np.repeat(begin - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+			points[minutiae_type] = self.points[minutiae_type][rows]
+			owner[minutiae_type] = np.repeat(np.arange(len(indexes)), counts)
+			offsets[minutiae_type] = np.concatenate([[0], np.cumsum(counts)])
+			if self.cells is not None:
+				cells[minutiae_type] = self.cells[minutiae_type][rows] + \
+					(owner[minutiae_type] - self.owner[minutiae_type][rows]) * _TEMPLATE_STRIDE
+		return MinutiaeGallery(points, owner, offsets, [self.records[index] for index in indexes],
+							   cells if self.cells is not None else None, self.cell_size)
+
+	def scores(self, probe, r0 = DISTANCE_THRESHOLD, t0 = ANGLE_THRESHOLD, one_to_one = False, block_size = 1 << 16,
+			   use_grid = True):
+		"""
+		Number of matched minutiae of every template.
+		By default a template minutiae is counted when any probe minutiae of the same type matches it, which is
+		the rule of pipline.search_image; one_to_one pairs every probe minutiae with at most one template
+		minutiae (greedy_assignment).
+		:param probe: list of [type, x, y, angle] or (m, 4) array
+		:param block_size: number of gallery minutiae compared at once, bounds the size of the matrices
+		:param use_grid: only pair minutiae of neighbouring grid cells when the gallery has a grid index,
+						 otherwise compare every pair
+		:return: (n_templates,) int array
+		"""
+		probe = pack_minutiaes(probe) if not isinstance(probe, np.ndarray) else probe
+		use_grid = use_grid and self.cells is not None
+		scores = np.zeros(len(self), dtype = np.int64)
+		for minutiae_type in MINUTIAE_TYPES:
+			probe_points = probe[probe[:, 0] == minutiae_type, 1:]
+			if len(probe_points) == 0:
+				continue
+			offsets = self.offsets[minutiae_type]
+			begin = 0
+			while begin < len(self):
+				# blocks end on a template boundary so one_to_one never splits a template
+				end = max(int(np.searchsorted(offsets, offsets[begin] + block_size, side = 'right')) - 1, begin + 1)
+				end = min(end, len(self))
+				rows = slice(offsets[begin], offsets[end])
+				gallery_points = self.points[minutiae_type][rows]
+				owner = self.owner[minutiae_type][rows]
+				if use_grid:
+					probe_index, pair_rows = grid_pairs(probe_points, self.cells[minutiae_type][rows],
+														np.arange(begin, end), self.cell_size, r0)
+					compatible = match_pairs(np.take(probe_points, probe_index, axis = 0),
+											 np.take(gallery_points, pair_rows, axis = 0), r0, t0)
+					probe_index = probe_index[compatible]; pair_rows = pair_rows[compatible]
+					if one_to_one:
+						matched = greedy_pair_assignment(probe_index, pair_rows, owner, len(owner))
+					else:
+						matched = np.zeros(len(owner), dtype = bool)
+						matched[pair_rows] = True
+				else:
+					compatible = match_matrix(probe_points, gallery_points, r0, t0)
+					matched = greedy_assignment(compatible, owner) if one_to_one else compatible.any(axis = 0)
+				scores += np.bincount(owner[matched], minlength = len(self))
+				begin = end
+		return scores
+
+	def score_bounds(self, probe, t0 = ANGLE_THRESHOLD, one_to_one = False):
+		"""
+		Cheap upper bound of the score of every template: a template minutiae can only be matched by a probe
+		minutiae of the same type whose angle differs by less than t0 (no angle test when t0 is None, e.g. for
+		aligned matching where the probe angles are rotated), and one_to_one cannot match more minutiae than the
+		probe has.
+		:return: (n_templates,) int array
+		"""
+		probe = pack_minutiaes(probe) if not isinstance(probe, np.ndarray) else probe
+		bounds = np.zeros(len(self), dtype = np.int64)
+		for minutiae_type in MINUTIAE_TYPES:
+			angles = np.sort(probe[(probe[:, 0] == minutiae_type) & ~np.isnan(probe[:, 3]), 3])
+			gallery_angles = self.points[minutiae_type][:, 2]
+			if len(angles) == 0:
+				continue
+			reachable = ~np.isnan(gallery_angles)
+			if t0 is not None:
+				# circular distance to the closest probe angle, from its two neighbours in the sorted angles
+				position = np.searchsorted(angles, gallery_angles)
+				closest = np.full(len(gallery_angles), np.inf)
+				for neighbour in (angles[position % len(angles)], angles[position - 1]):
+					angle_diff = np.abs(gallery_angles - neighbour)
+					closest = np.minimum(closest, np.minimum(angle_diff, 2*pi - angle_diff))
+				reachable &= closest < t0
+			counts = np.bincount(self.owner[minutiae_type][reachable], minlength = len(self))
+			bounds += np.minimum(counts, len(angles)) if one_to_one else counts
+		return bounds
+
+	def identify(self, probe, k = 1, order = None, batch_size = 64, r0 = DISTANCE_THRESHOLD, t0 = ANGLE_THRESHOLD,
+				 one_to_one = False, **kwargs):
+		"""
+		search with a top k heap and score_bounds: templates that cannot enter the top k are not scored.
+		:param order: visiting order (e.g. TripletIndex.candidates), bounds descending by default
+		:param batch_size: number of templates scored at once
+		:return: (list of (template index, score) like search, number of pruned templates)
+		"""
+		probe = pack_minutiaes(probe) if not isinstance(probe, np.ndarray) else probe
+		bounds = self.score_bounds(probe, t0, one_to_one)
+		score = lambda indexes: self.subset(indexes).scores(probe, r0 = r0, t0 = t0, one_to_one = one_to_one,
+															 **kwargs)
+		return bounded_top_k(bounds, score, k, order, batch_size)
+
+	def search(self, probe, k = 1, **kwargs):
+		"""
+		Top k templates for the probe, best first, ties broken by gallery order.
+		:return: list of (template index, score)
+		"""
+		scores = self.scores(probe, **kwargs)
+		order = np.argsort(-scores, kind = 'stable')[:k]
+		return [(int(index), int(scores[index])) for index in order]
+
+
+if __name__ == '__main__':
+	# identify has to return the top k of the exhaustive search whatever the batch size. In the first gallery the
+	# second batch of 2 mixes a template that enters the top 1 (index 2) with one that cannot (index 3).
+	probe = [[0, 100, 100, 1.], [0, 200, 200, 1.]]
+	far = [[0, 400, 0, 1.]]
+	galleries = [(MinutiaeGallery.from_templates([far * 3, far * 2, probe, [[0, 0, 400, 3.]]]), [probe])]
+	rng = np.random.default_rng(0)
+	counts = rng.integers(20, 60, 300)
+	points = np.column_stack([(rng.random(counts.sum()) < .2), rng.integers(0, 300, (counts.sum(), 2)),
+							  rng.random(counts.sum()) * 2*pi]).astype(np.float64)
+	gallery = MinutiaeGallery.from_arrays(points, np.repeat(np.arange(len(counts)), counts), len(counts))
+	# few minutiae per probe so that the bounds are tight and templates get pruned inside a batch
+	galleries.append((gallery, [rng.permutation(gallery.template(int(index)))[:6] + np.r_[0, rng.normal(0, 3, 2), 0]
+								for index in rng.integers(0, len(counts), 50)]))
+	for gallery, probes in galleries:
+		for k in (1, 5):
+			for batch_size in (1, 2, 3, 64):
+				mismatches = sum(gallery.identify(probe, k, batch_size = batch_size)[0] != gallery.search(probe, k)
+								 for probe in probes)
+				print('%d templates, k %d, batch size %2d: %d / %d probes differ from search' % (
+					len(gallery), k, batch_size, mismatches, len(probes)))
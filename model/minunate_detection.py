@@ -1,12 +1,14 @@
 import numpy as np
 import math 
 import cv2 as cv
-from queue import Queue
+import scipy.ndimage
 from math import acos
 import math
+from utils.crossing_number import RING_3, crossing_number_lut
 # hough 
 # 
 pi = acos(-1)
+_CROSSING_NUMBER_LUT = crossing_number_lut(len(RING_3))
 def check_border(biniry_image,x,y):
 	(x_max,y_max) = biniry_image.shape
 	i = x - 1
@@ -52,24 +54,32 @@ def get_matrix_pad_zeros(matrix):
 	res.append(np.zeros(y+2))
 	return np.array(res)
 
-def get_line_matrix(biniry_image,point,w = 3):
-	res_matrix = np.zeros((2*w+1,2*w+1))
-	queue = Queue(maxsize = 10000) 
-	(x,y) = point
-	queue.put(point)
-	dx = [-1, -1, -1, 0, 1, 1, 1, 0]
-	dy = [-1, 0, 1, 1, 1, 0, -1, -1]
+def get_line_matrices(biniry_image, points, w = 3):
+	"""
+	Ridge traced from every point inside its (2w+1)x(2w+1) window, all points at once: the 8-connected
+	component of the point in each window, which is what the breadth first trace of get_line_matrix visits.
+	:param biniry_image: 2d int8 image, ridges are 1
+	:param points: (n, 2) array of (row, column)
+	:return: (n, 2w+1, 2w+1) float array, 1 on the traced ridge
+	"""
+	points = np.asarray(points, dtype = int).reshape(-1, 2)
+	padded = np.pad(biniry_image == 1, w)
+	offsets = np.arange(0, 2*w + 1)
+	rows = points[:, 0, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+	cols = points[:, 1, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+	windows = padded[rows, cols]
 
-	while queue.empty() != True:
-		(get_x,get_y) = queue.get()
-		res_matrix[get_x - x + w ][get_y - y + w] = 1
-		for i in range(8):
-			if biniry_image[get_x + dx[i]][get_y + dy[i]] == 1:
+	# label every window separately: connectivity only inside the plane of a window
+	structure = np.zeros((3, 3, 3), dtype = bool)
+	structure[1] = True
+	labels, _ = scipy.ndimage.label(windows, structure = structure)
+	centre = labels[:, w, w][:, np.newaxis, np.newaxis]
+	res_matrix = (labels == centre) & (centre > 0)
+	res_matrix[:, w, w] = True
+	return res_matrix.astype(np.float64)
 
-				if abs( get_x + dx[i] - x) <= w and abs(get_y + dy[i]-y) <= w  and res_matrix[get_x + dx[i] - x + w ][get_y+dy[i] - y + w]  == 0:
-					new_point = (get_x + dx[i],get_y + dy[i])			
-					queue.put(new_point)
-	return res_matrix
+def get_line_matrix(biniry_image,point,w = 3):
+	return get_line_matrices(biniry_image, [point], w)[0]
 
 def norm_l2(point):
 	(x,y) = point
@@ -166,35 +176,37 @@ def find_point_of_vetor(matrix, minunatiae_tpye):
 		return res_point
 
 
-def get_orient(point, minunatiae_tpye, matrix):
+def ridge_centroid(matrix):
+	"""
+	Centre of mass of the traced ridge, used as second point when find_point_of_vetor finds none.
+	"""
+	(n,m) = matrix.shape
+	ridge_x, ridge_y = np.nonzero(matrix)
+	if len(ridge_x) == 0:
+		return (n//2, m//2)
+	return (np.mean(ridge_x), np.mean(ridge_y))
+
+def direction_angles(vectors):
+	"""
+	Angle in [0, 2*pi) of (row, column) vectors against (0, 1), counter clockwise with rows going down,
+	same as the acos based computation of get_orient.
+	"""
+	vectors = np.asarray(vectors, dtype = np.float64).reshape(-1, 2)
+	return np.mod(np.arctan2(-vectors[:, 0], vectors[:, 1]), 2*pi)
 
+def get_orient_vector(minunatiae_tpye, matrix):
 	point_two = find_point_of_vetor(matrix,minunatiae_tpye)
 	if  point_two == None:
-		print('loi tim diem thu 2')
-		return None
-	(y,x) = point
+		# the ridge does not leave the window in a usable way: fall back to its centre of mass
+		point_two = ridge_centroid(matrix)
 
 	(x_centroi,y_centroi) = matrix.shape
-	x_centroi = x_centroi // 2 
-	y_centroi = y_centroi // 2 
-	# print(' ass '+  str (point_two ))
-	vector_1 = (0,1)
-	vector_2 = (x_centroi - point_two[0], y_centroi - point_two[1])
-	# print(vector_2)
-
-	theta = acos(calculation_cos(vector_1, vector_2))
-	# print(theta)
-	if vector_2[0] >= 0:
-		# print(vector_2[0])
-		if vector_2[0] == 0:
-			if vector_2[1] < 0: 
-				return pi
-			else:
-				return 0.0
-		else:
-			return 2*pi - theta 
-	else:
-		return theta 
+	x_centroi = x_centroi // 2
+	y_centroi = y_centroi // 2
+	return (x_centroi - point_two[0], y_centroi - point_two[1])
+
+def get_orient(point, minunatiae_tpye, matrix):
+	return float(direction_angles(get_orient_vector(minunatiae_tpye, matrix))[0])
 
 def check_minunatiae_point(biniry_image,x,y, w = 9):
 
@@ -234,6 +246,50 @@ def check_minunatiae_at(biniry_image,x,y):
 			return 1
 	return -1
 
+def minunatiae_type_map(biniry_image):
+	"""
+	check_minunatiae_at for every pixel at once: -1, 0 (ending) or 1 (bifurcation); the image border is -1.
+	"""
+	(x_max, y_max) = biniry_image.shape
+	ridge = (biniry_image == 1).astype(np.uint32)
+	code = np.zeros((x_max - 2, y_max - 2), np.uint32)
+	for bit, (dx, dy) in enumerate(RING_3):
+		code |= ridge[1 + dx:x_max - 1 + dx, 1 + dy:y_max - 1 + dy] << bit
+	crossing = _CROSSING_NUMBER_LUT[code]
+	types = np.full((x_max, y_max), -1, np.int8)
+	types[1:-1, 1:-1] = np.where((crossing == 255) | (ridge[1:-1, 1:-1] == 0), -1, crossing)
+	return types
+
+
+def valid_minunatiae_map(biniry_image, types, w = 9):
+	"""
+	check_minunatiae_point for every pixel at once: far enough from the image border, ridge pixels on the four
+	sides in its row and column (check_border) and no other candidate minutiae within a radius of 6 pixels.
+	"""
+	(x_max, y_max) = biniry_image.shape
+	ridge = biniry_image == 1
+	rows = np.arange(x_max)[:, np.newaxis]
+	cols = np.arange(y_max)[np.newaxis, :]
+
+	# first / last ridge pixel of every column and row
+	has_ridge_col = ridge.any(axis = 0)
+	first_in_col = np.where(has_ridge_col, np.argmax(ridge, axis = 0), x_max)
+	last_in_col = np.where(has_ridge_col, x_max - 1 - np.argmax(ridge[::-1], axis = 0), -1)
+	has_ridge_row = ridge.any(axis = 1)
+	first_in_row = np.where(has_ridge_row, np.argmax(ridge, axis = 1), y_max)
+	last_in_row = np.where(has_ridge_row, y_max - 1 - np.argmax(ridge[:, ::-1], axis = 1), -1)
+	border = (first_in_col[np.newaxis, :] < rows) & (last_in_col[np.newaxis, :] > rows) & \
+		(first_in_row[:, np.newaxis] < cols) & (last_in_row[:, np.newaxis] > cols)
+
+	# number of candidates in the disk i**2 + j**2 <= 36 around every pixel
+	disk = np.arange(-w, w + 1)
+	disk = (disk[:, np.newaxis] ** 2 + disk[np.newaxis, :] ** 2 <= 36).astype(np.float32)
+	density = cv.filter2D((types != -1).astype(np.float32), -1, disk, borderType = cv.BORDER_CONSTANT)
+
+	inside = (rows >= w) & (rows + w < x_max) & (cols >= w) & (cols + w < y_max)
+	return inside & border & (np.rint(density) <= 1)
+
+
 def get_minunatiaes_point(im):
 	biniry_image = np.zeros_like(im)
 	biniry_image[im<10] = 1.0
@@ -241,22 +297,26 @@ def get_minunatiaes_point(im):
 	result = []
 	i_max, j_max = biniry_image.shape
 	result_im = cv.cvtColor(im, cv.COLOR_GRAY2RGB)
-	for i in range(2,i_max-1):
-		for j in range(2,j_max-1):
-			if biniry_image[i][j] == 1:
-				minunatiae_tpye = check_minunatiae_at(biniry_image,i,j)
-				if minunatiae_tpye != -1 and check_minunatiae_point(biniry_image.copy(),i,j) == True:
-					# for k1 in range(-2,3):
-					# 	for k2 in range(-2,3):
-					# 		print(biniry_image[i+k1][j+k2] , end = " ")
-					# 	print()
-					#print(str(i) +' '+ str(j))
-					#print('')
-					matrix = get_line_matrix(biniry_image,(i,j))
-					result.append((minunatiae_tpye,(i,j), get_orient((i,j), minunatiae_tpye, matrix )  ) )
-					if minunatiae_tpye == 0:
-						cv.circle(result_im, (j,i), radius=2, color=(0, 150, 0), thickness=2)
-					else:
-						cv.circle(result_im, (j,i), radius=2, color=(150, 0, 0), thickness=2)
-	
-	return result,result_im
\ No newline at end of file
+
+	# crossing number, border and neighbourhood tests computed once for the whole image
+	types = minunatiae_type_map(biniry_image)
+	candidates = valid_minunatiae_map(biniry_image, types) & (types != -1)
+	candidates[:2, :] = False
+	candidates[:, :2] = False
+	candidates[i_max - 1:, :] = False
+	candidates[:, j_max - 1:] = False
+
+	# directions of all minutiae: traced ridges and angles computed in batch
+	points = np.argwhere(candidates)
+	point_types = types[candidates].astype(int)
+	matrices = get_line_matrices(biniry_image, points)
+	orients = direction_angles([get_orient_vector(t, matrix) for t, matrix in zip(point_types, matrices)])
+
+	for (i, j), minunatiae_tpye, orient in zip(points.tolist(), point_types.tolist(), orients.tolist()):
+		result.append((minunatiae_tpye,(i,j), orient ) )
+		if minunatiae_tpye == 0:
+			cv.circle(result_im, (j,i), radius=2, color=(0, 150, 0), thickness=2)
+		else:
+			cv.circle(result_im, (j,i), radius=2, color=(150, 0, 0), thickness=2)
+
+	return result,result_im
@@ -2,7 +2,6 @@
 '''
 import library 
 '''
-from torchsummary import summary
 import torch 
 from torch import nn
 import numpy as np 
@@ -53,8 +52,8 @@ class CNNnet(torch.nn.Module):
 		self.fc3 = nn.Linear(64,10)
 
 
-	def forward(self,x):
-
+	def features(self,x):
+		# 64-dim bottleneck (output of fc2), the embedding used for retrieval
 		out = self.conv2d1(x)
 		out = self.conv2d2(out)
 		out = self.conv2d3(out)
@@ -63,10 +62,16 @@ class CNNnet(torch.nn.Module):
 		out = self.fc1(out)
 		out = self.dp1(out)
 		out = self.fc2(out)
+		return out
+
+	def forward(self,x):
+
+		out = self.features(x)
 		out = self.dp2(out)
 		out = self.fc3(out)
 		return out
 '''
+from torchsummary import summary
 def summary_model():		
 	model = CNNnet()
 	print(summary( model ,(1,160,160)))
@@ -0,0 +1,124 @@
+"""
+Orientation field embedding, a coarse prefilter in front of the minutiae matcher.
+
+The smoothed block orientation field of a print is resampled on a fixed grid centred on its core (the centre of
+the segmentation mask when no core is found) as doubled angle (cos 2a, sin 2a) pairs, zeroed outside the mask. Two
+fields then compare by the dot product of their vectors, the mean of cos(2 (a1 - a2)) over the cells valid in both,
+and every print is a unit float32 vector of a VectorIndex, whose exact nearest neighbours (one matrix product) are
+the shortlist passed to the minutiae matcher.
+
+    python -m model.orientation_index [gallery.json] [test directory]
+
+prints the shortlist recall on the test split and the query latency against the size of the gallery.
+"""
+import json
+import sys
+import time
+import cv2 as cv
+import numpy as np
+from data import read_image_rgb
+from utils.orientation import block_coordinate
+from .pattern_class import orientation_field, smooth_orientation, singular_points, block_mask
+from .vector_index import VectorIndex, random_embeddings
+
+EMBEDDING_GRID = 16
+EMBEDDING_STEP = 16
+
+
+def orientation_embedding(angles, mask, w = 16, grid = EMBEDDING_GRID, step = EMBEDDING_STEP):
+	"""
+	:param angles: orientation field of calculate_angles
+	:param mask: segmentation mask of the image
+	:param grid: number of samples along each axis
+	:param step: distance between two samples in pixels
+	:return: (2 * grid * grid,) unit float32 vector, zero when the grid misses the mask
+	"""
+	angles = smooth_orientation(angles)
+	cores, _, _ = singular_points(angles, mask, w)
+	if cores:
+		x, y = cores[0]
+	else:
+		rows, cols = np.nonzero(mask)
+		x, y = (cols.mean(), rows.mean()) if len(rows) else (mask.shape[1] / 2, mask.shape[0] / 2)
+
+	# sample positions in block coordinates, with the block origin of calculate_angles
+	offsets = (np.arange(grid) - (grid - 1) / 2) * step
+	map_x, map_y = np.meshgrid(block_coordinate(x + offsets, w), block_coordinate(y + offsets, w))
+	map_x = map_x.astype(np.float32); map_y = map_y.astype(np.float32)
+	def sample(field, interpolation):
+		return cv.remap(field.astype(np.float32), map_x, map_y, interpolation, borderMode = cv.BORDER_CONSTANT,
+						borderValue = 0)
+	inside = sample(block_mask(mask, angles.shape, w), cv.INTER_NEAREST)
+	vector = np.concatenate([(sample(np.cos(2 * angles), cv.INTER_LINEAR) * inside).ravel(),
+							 (sample(np.sin(2 * angles), cv.INTER_LINEAR) * inside).ravel()])
+	norm = np.linalg.norm(vector)
+	return vector / norm if norm > 0 else vector
+
+
+def extract_image_embedding(image, w = 16):
+	"""
+	orientation_embedding of a grayscale image.
+	"""
+	angles, mask = orientation_field(image, w)
+	return orientation_embedding(angles, mask, w)
+
+
+def extract_embedding(path, w = 16):
+	return extract_image_embedding(read_image_rgb(path), w)
+
+
+class OrientationIndex(VectorIndex):
+	"""
+	VectorIndex over the orientation embeddings of a gallery.
+	"""
+	@classmethod
+	def from_images(cls, paths, records = None, **kwargs):
+		"""
+		:param paths: image file of every template
+		:param kwargs: passed to orientation_embedding
+		"""
+		vectors = [orientation_embedding(*orientation_field(read_image_rgb(path)), **kwargs) for path in paths]
+		return cls(np.array(vectors, dtype = np.float32).reshape(len(paths), -1), records)
+
+
+if __name__ == '__main__':
+	# python -m model.orientation_index data/dataset/db_data.json data/dataset/test
+	from .matching import MinutiaeGallery
+	from .extraction import extract_template, split_images, finger_id, TEST_PATH, TRAIN_PATH
+	from .triplet_index import recall_curve
+	gallery_path = sys.argv[1] if len(sys.argv) > 1 else './data/dataset/db_data.json'
+	test_path = sys.argv[2] if len(sys.argv) > 2 else TEST_PATH
+	with open(gallery_path, mode = 'r') as f:
+		data = json.load(f)
+	start = time.time()
+	index = OrientationIndex.from_images([TRAIN_PATH + '/' + record['img'] for record in data], data)
+	print('index: %d templates, %d dimensions, %.2fs' % (len(index), index.vectors.shape[1], time.time() - start))
+	fingers = np.array([finger_id(record['img']) for record in data])
+
+	images = split_images(test_path)
+	start = time.time()
+	embeddings = [extract_embedding(test_path + '/' + image) for image in images]
+	embedding_time = (time.time() - start) / len(images)
+	ranks = np.array([np.flatnonzero(fingers[index.shortlist(embedding, len(index))] == finger_id(image))[0]
+					  for image, embedding in zip(images, embeddings)])
+	sizes = [n for n in (1, 2, 5, 10, 20, 50, 100) if n < len(index)] + [len(index)]
+	print('N'.ljust(28) + ''.join(str(n).rjust(7) for n in sizes))
+	print('shortlist recall'.ljust(28) + ''.join(('%.3f' % recall).rjust(7) for _, recall in recall_curve(ranks, sizes)))
+
+	# accuracy of the two stage search: rank 1 of the minutiae matcher over the shortlist
+	gallery = MinutiaeGallery.from_records(data)
+	probes = [extract_template(test_path + '/' + image) for image in images]
+	rank_1 = [np.mean([fingers[index.search(embedding, probe, gallery, n)[0][0]] == finger_id(image)
+					   for image, embedding, probe in zip(images, embeddings, probes)]) for n in sizes]
+	print('rank-1 after matcher'.ljust(28) + ''.join(('%.3f' % accuracy).rjust(7) for accuracy in rank_1))
+	print('embedding: %.2f ms per image' % (embedding_time * 1e3))
+
+	# query latency against the gallery size, random vectors of the same dimension
+	for n_templates in (1000, 10000, 100000, 200000):
+		large = OrientationIndex(random_embeddings(n_templates, index.vectors.shape[1]))
+		queries = random_embeddings(50, index.vectors.shape[1], seed = 1)
+		large.shortlist(queries[0])
+		start = time.time()
+		for query in queries:
+			large.shortlist(query)
+		print('gallery %7d: %.3f ms per query' % (n_templates, (time.time() - start) / len(queries) * 1e3))
@@ -0,0 +1,260 @@
+"""
+Coarse pattern class of a fingerprint (arch, left loop, right loop, whorl) from its singular points, and the
+gallery partitioned by class.
+
+The singular points are the blocks of the smoothed orientation field whose Poincare index is a half turn (core or
+delta) or a full turn (whorl). The class follows from their number and positions: no core is an arch, two cores or
+a whorl point a whorl, and a single core a loop whose side is given by the delta, or when the delta is outside the
+image by the direction in which the loop opens. A probe is searched in the templates of its own class (and the
+unclassified ones) first, then in the neighbouring classes when nothing matched well enough.
+
+    python -m model.pattern_class [gallery.json] [test directory]
+
+prints the class distribution, the fraction of the gallery scanned per probe and the rank-1 accuracy against the
+full scan.
+"""
+import json
+import sys
+import time
+import cv2 as cv
+import numpy as np
+from data import normalize, create_segmented_and_variance_images, calculate_angles, read_image_rgb
+from utils.poincare import detect_singularities
+from utils.orientation import block_centre, block_coordinate
+
+ARCH, LEFT_LOOP, RIGHT_LOOP, WHORL, UNKNOWN = range(5)
+PATTERN_CLASSES = ('arch', 'left_loop', 'right_loop', 'whorl', 'unknown')
+# classes confused with each other by a misplaced or missing singular point (tented arch, loop with a second core)
+NEIGHBOUR_CLASSES = {
+	ARCH: (LEFT_LOOP, RIGHT_LOOP),
+	LEFT_LOOP: (ARCH, WHORL),
+	RIGHT_LOOP: (ARCH, WHORL),
+	WHORL: (LEFT_LOOP, RIGHT_LOOP),
+	UNKNOWN: (ARCH, LEFT_LOOP, RIGHT_LOOP, WHORL),
+}
+ORIENTATION_SMOOTHING = 1.
+POINCARE_TOLERANCE = 10
+OPENING_THRESHOLD = .2
+# score under which the neighbouring classes are searched too
+FALLBACK_SCORE = 15
+
+
+def smooth_orientation(angles, sigma = ORIENTATION_SMOOTHING):
+	"""
+	Gaussian smoothing of the block orientation field, done on the doubled angle vectors.
+	:param sigma: standard deviation in blocks
+	"""
+	cos = cv.GaussianBlur(np.cos(2 * angles), (0, 0), sigma)
+	sin = cv.GaussianBlur(np.sin(2 * angles), (0, 0), sigma)
+	return np.mod(np.arctan2(sin, cos) / 2, np.pi)
+
+
+def orientation_field(image, w = 16):
+	"""
+	Block orientation field and segmentation mask of a grayscale image, computed like extract_image_template.
+	:return: (angles, mask)
+	"""
+	image = normalize(image, m0 = float(100), v0 = float(100))
+	image_segment, _, mask = create_segmented_and_variance_images(image, w = w, threshold = .4)
+	return calculate_angles(image_segment, w), mask
+
+
+def block_mask(mask, shape, w = 16):
+	"""
+	Segmentation mask taken at the centre of every block of an orientation field of the given shape.
+	"""
+	block_i, block_j = np.mgrid[0:shape[0], 0:shape[1]]
+	return mask[np.minimum(block_centre(block_i, w), mask.shape[0] - 1),
+				np.minimum(block_centre(block_j, w), mask.shape[1] - 1)] > 0
+
+
+def _merge_points(points, radius):
+	"""
+	Centroids of the groups of detections closer than radius (one singular point is found by up to four blocks).
+	"""
+	groups = []
+	for x, y in points:
+		for group in groups:
+			if np.hypot(group[0] / group[2] - x, group[1] / group[2] - y) <= radius:
+				group[0] += x; group[1] += y; group[2] += 1
+				break
+		else:
+			groups.append([x, y, 1])
+	return [(x / count, y / count) for x, y, count in groups]
+
+
+def singular_points(angles, mask, w = 16, tolerance = POINCARE_TOLERANCE):
+	"""
+	:param angles: orientation field of calculate_angles, smoothed
+	:param mask: segmentation mask of the image
+	:return: (cores, deltas, whorls), lists of (x, y) pixel positions
+	"""
+	detected = detect_singularities(angles, tolerance, w, mask)
+	points = {name: [position for singularity, position in detected if singularity == name]
+			  for name in ('loop', 'delta', 'whorl')}
+	return (_merge_points(points['loop'], 1.5 * w), _merge_points(points['delta'], 1.5 * w),
+			_merge_points(points['whorl'], 1.5 * w))
+
+
+def loop_opening(angles, mask, core, w = 16, radius = (1.5, 5)):
+	"""
+	Direction in which a loop opens: around a core the ridges only run away from it on the side of the opening.
+	:param core: (x, y) pixel position of the core
+	:param radius: ring of blocks around the core used, in blocks
+	:return: unit (dx, dy) vector, zero when no block of the ring is usable
+	"""
+	rows, cols = angles.shape
+	block_i, block_j = np.mgrid[0:rows, 0:cols]
+	inside = block_mask(mask, angles.shape, w)
+	drow = block_i - block_coordinate(core[1], w)
+	dcol = block_j - block_coordinate(core[0], w)
+	distance = np.hypot(drow, dcol)
+	radial = np.arctan2(drow, dcol)
+	alignment = np.cos(2 * (angles - radial))
+	selected = inside & (distance >= radius[0]) & (distance <= radius[1]) & (alignment > 0)
+	vector = np.array([np.sum(alignment[selected] * np.cos(radial[selected])),
+					   np.sum(alignment[selected] * np.sin(radial[selected]))])
+	norm = np.linalg.norm(vector)
+	return vector / norm if norm > 0 else vector
+
+
+def classify_orientation(angles, mask, w = 16, sigma = ORIENTATION_SMOOTHING, opening_threshold = OPENING_THRESHOLD):
+	"""
+	:param angles: orientation field of calculate_angles
+	:param mask: segmentation mask of the image
+	:param opening_threshold: horizontal part of the loop opening under which a loop without delta is taken for a
+							  tented arch
+	:return: class code, index in PATTERN_CLASSES
+	"""
+	angles = smooth_orientation(angles, sigma) if sigma else angles
+	cores, deltas, whorls = singular_points(angles, mask, w)
+	if whorls or len(cores) >= 2:
+		return WHORL
+	if len(cores) == 0:
+		# a delta without core is a partial print
+		return UNKNOWN if deltas else ARCH
+	if deltas:
+		# the delta lies on the opposite side of the opening of the loop
+		return LEFT_LOOP if deltas[0][0] > cores[0][0] else RIGHT_LOOP
+	dx, _ = loop_opening(angles, mask, cores[0], w)
+	if dx < -opening_threshold:
+		return LEFT_LOOP
+	if dx > opening_threshold:
+		return RIGHT_LOOP
+	return ARCH
+
+
+def image_pattern_class(image, w = 16):
+	"""
+	Class of a grayscale image.
+	"""
+	angles, mask = orientation_field(image, w)
+	return classify_orientation(angles, mask, w)
+
+
+def pattern_class(path, w = 16):
+	return image_pattern_class(read_image_rgb(path), w)
+
+
+def class_code(name):
+	"""
+	Code of a class name as stored in the records, UNKNOWN for a missing one.
+	"""
+	return PATTERN_CLASSES.index(name) if name in PATTERN_CLASSES else UNKNOWN
+
+
+def record_classes(records):
+	"""
+	(n_templates,) class codes of the gallery records: the classes section of a TemplateStore, or the 'class' of
+	every db_data.json record.
+	"""
+	if hasattr(records, 'classes'):
+		classes = np.asarray(records.classes, dtype = np.int64)
+		return np.where(classes < len(PATTERN_CLASSES), classes, UNKNOWN)
+	return np.array([class_code(record.get('class')) for record in records], dtype = np.int64)
+
+
+class PatternBins(object):
+	"""
+	Gallery partitioned by pattern class, one MinutiaeGallery per class.
+	"""
+	def __init__(self, gallery, classes):
+		"""
+		:param gallery: MinutiaeGallery
+		:param classes: (n_templates,) class code of every template
+		"""
+		classes = np.asarray(classes, dtype = np.int64)
+		self.n_templates = len(gallery)
+		self.indexes = {code: np.flatnonzero(classes == code) for code in range(len(PATTERN_CLASSES))}
+		self.bins = {code: gallery.subset(indexes) for code, indexes in self.indexes.items() if len(indexes)}
+
+	def __len__(self):
+		return self.n_templates
+
+	def sizes(self):
+		return {PATTERN_CLASSES[code]: len(indexes) for code, indexes in self.indexes.items()}
+
+	def _search(self, probe, codes, k, **kwargs):
+		results = []
+		for code in codes:
+			if code in self.bins:
+				results.extend((int(self.indexes[code][index]), score)
+							   for index, score in self.bins[code].search(probe, k, **kwargs))
+		return results
+
+	def search(self, probe, probe_class, k = 1, fallback_score = FALLBACK_SCORE, **kwargs):
+		"""
+		Top k searched in the class of the probe and the unclassified templates, then in the neighbouring classes
+		when the best score is under fallback_score.
+		:param probe_class: class code of the probe
+		:param kwargs: passed to MinutiaeGallery.search
+		:return: (list of (template index, score) best first, number of templates scanned)
+		"""
+		codes = [probe_class] if probe_class == UNKNOWN else [probe_class, UNKNOWN]
+		results = self._search(probe, codes, k, **kwargs)
+		if not results or max(score for _, score in results) < fallback_score:
+			neighbours = [code for code in NEIGHBOUR_CLASSES[probe_class] if code not in codes]
+			results += self._search(probe, neighbours, k, **kwargs)
+			codes += neighbours
+		scanned = sum(len(self.indexes[code]) for code in codes)
+		results.sort(key = lambda item: (-item[1], item[0]))
+		return results[:k], scanned
+
+
+if __name__ == '__main__':
+	# python -m model.pattern_class data/dataset/db_data.json data/dataset/test
+	from .matching import MinutiaeGallery
+	from .extraction import extract_template, split_images, finger_id, TEST_PATH, TRAIN_PATH
+	gallery_path = sys.argv[1] if len(sys.argv) > 1 else './data/dataset/db_data.json'
+	test_path = sys.argv[2] if len(sys.argv) > 2 else TEST_PATH
+	with open(gallery_path, mode = 'r') as f:
+		data = json.load(f)
+	# galleries enrolled before the classes were stored: classify the train images
+	classes = np.array([class_code(record['class']) if 'class' in record else
+						pattern_class(TRAIN_PATH + '/' + record['img']) for record in data], dtype = np.int64)
+	gallery = MinutiaeGallery.from_records(data)
+	bins = PatternBins(gallery, classes)
+	print('gallery classes: %s' % bins.sizes())
+
+	images = split_images(test_path)
+	start = time.time()
+	probe_classes = [pattern_class(test_path + '/' + image) for image in images]
+	class_time = (time.time() - start) / len(images)
+	probes = [extract_template(test_path + '/' + image) for image in images]
+	fingers = np.array([finger_id(record['img']) for record in data])
+	print('probe classes: %s' % {PATTERN_CLASSES[code]: probe_classes.count(code) for code in range(len(PATTERN_CLASSES))})
+
+	# agreement of the class of every probe with the classes of the train impressions of its finger
+	agreement = [np.mean(classes[fingers == finger_id(image)] == code) for image, code in zip(images, probe_classes)]
+	start = time.time()
+	full_hits = [fingers[gallery.search(probe)[0][0]] == finger_id(image) for image, probe in zip(images, probes)]
+	full_time = (time.time() - start) / len(probes)
+	start = time.time()
+	binned = [bins.search(probe, code) for probe, code in zip(probes, probe_classes)]
+	binned_time = (time.time() - start) / len(probes)
+	binned_hits = [fingers[results[0][0]] == finger_id(image) for image, (results, _) in zip(images, binned)]
+	print('class agreement with the train impressions: %.3f' % np.mean(agreement))
+	print('fraction of the gallery scanned per probe: %.3f' % (np.mean([scanned for _, scanned in binned]) / len(gallery)))
+	print('rank-1: full scan %.3f, class bins %.3f' % (np.mean(full_hits), np.mean(binned_hits)))
+	print('per probe: classification %.2f ms, full scan %.2f ms, class bins %.2f ms' % (
+		class_time * 1e3, full_time * 1e3, binned_time * 1e3))
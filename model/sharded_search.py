@@ -0,0 +1,160 @@
+"""
+Sharded 1:N search over worker processes. The gallery (a binary store, or db_data.json) is split into contiguous
+shards of templates; every worker process loads its shards once when it starts and answers chunks of probes with
+the local top k of each probe (MinutiaeGallery.search), which the parent merges.
+
+    python -m model.sharded_search --synthetic 100000 --workers 1 2 4
+
+measures the probe throughput against the number of workers on a synthetic gallery.
+"""
+import argparse
+import heapq
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .matching import MinutiaeGallery, MINUTIAE_TYPES
+from .template_store import open_gallery, write_gallery_store
+
+CHUNK_SIZE = 16
+
+_worker_shards = []
+
+
+def shard_bounds(n_templates, shards):
+	"""
+	(begin, end) template ranges of the shards, of sizes differing by at most one.
+	"""
+	edges = np.linspace(0, n_templates, shards + 1).astype(np.int64)
+	return [(int(begin), int(end)) for begin, end in zip(edges[:-1], edges[1:])]
+
+
+def merge_top_k(results, k):
+	"""
+	Best k of several lists of (template index, score), ties broken by template index like MinutiaeGallery.search.
+	"""
+	return heapq.nlargest(k, (item for result in results for item in result), key = lambda item: (item[1], -item[0]))
+
+
+def _load_shards(path, bounds):
+	global _worker_shards
+	gallery = open_gallery(path)
+	_worker_shards = [(begin, gallery.subset(np.arange(begin, end))) for begin, end in bounds]
+
+
+def _search_chunk(probes, k, kwargs):
+	results = []
+	for probe in probes:
+		local = [[(begin + index, score) for index, score in shard.search(probe, k, **kwargs)]
+				 for begin, shard in _worker_shards]
+		results.append(merge_top_k(local, k))
+	return results
+
+
+class ShardedSearch(object):
+	"""
+	Pool of worker processes, each one holding a fixed set of shards of the gallery for its whole life.
+	"""
+	def __init__(self, path, workers = None, shards = None, chunk_size = CHUNK_SIZE):
+		"""
+		:param path: binary store (memory mapped by every worker) or db_data.json
+		:param workers: number of processes, os.cpu_count() by default
+		:param shards: number of shards, one per worker by default; worker i holds shards i, i + workers, ...
+		:param chunk_size: number of probes sent to the workers at once
+		"""
+		self.workers = workers or os.cpu_count() or 1
+		self.shards = max(shards or self.workers, self.workers)
+		self.chunk_size = chunk_size
+		self.n_templates = len(open_gallery(path))
+		bounds = shard_bounds(self.n_templates, self.shards)
+		self.pools = [ProcessPoolExecutor(max_workers = 1, initializer = _load_shards,
+										  initargs = (path, bounds[worker::self.workers]))
+					  for worker in range(self.workers)]
+
+	def search(self, probes, k = 1, **kwargs):
+		"""
+		Top k of every probe over the whole gallery.
+		:param probes: list of templates, each one a list of [type, x, y, angle] or (m, 4) array
+		:param kwargs: passed to MinutiaeGallery.search
+		:return: list with, for every probe, the list of (template index, score) best first
+		"""
+		chunks = [probes[begin:begin + self.chunk_size] for begin in range(0, len(probes), self.chunk_size)]
+		futures = [[pool.submit(_search_chunk, chunk, k, kwargs) for pool in self.pools] for chunk in chunks]
+		results = []
+		for chunk_futures in futures:
+			per_worker = [future.result() for future in chunk_futures]
+			results.extend(merge_top_k(local, k) for local in zip(*per_worker))
+		return results
+
+	def close(self):
+		for pool in self.pools:
+			pool.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def synthetic_gallery(n_templates, minutiaes = (30, 70), shape = (400, 400), seed = 0):
+	"""
+	Random gallery for benchmarks: uniform positions and directions, 80% endings.
+	"""
+	rng = np.random.default_rng(seed)
+	counts = rng.integers(minutiaes[0], minutiaes[1], n_templates)
+	owner = np.repeat(np.arange(n_templates), counts)
+	n = len(owner)
+	points = np.column_stack([(rng.random(n) < .2).astype(np.float64), rng.integers(0, shape[0], n),
+							  rng.integers(0, shape[1], n), rng.random(n) * 2*np.pi])
+	return MinutiaeGallery.from_arrays(points, owner, n_templates)
+
+
+def synthetic_probes(gallery, n_probes, jitter = 3, seed = 1):
+	"""
+	Noisy copies of random templates of the gallery.
+	"""
+	rng = np.random.default_rng(seed)
+	probes = []
+	for index in rng.integers(0, len(gallery), n_probes):
+		template = gallery.template(int(index))
+		template[:, 1:3] += rng.normal(0, jitter, (len(template), 2)).round()
+		probes.append(template)
+	return probes
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Throughput of the sharded search against the number of workers')
+	parser.add_argument('--gallery', help = 'binary store or db_data.json, a synthetic gallery by default')
+	parser.add_argument('--synthetic', type = int, default = 100000, help = 'templates of the synthetic gallery')
+	parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+	parser.add_argument('--shards', type = int, default = None, help = 'shards per search, one per worker by default')
+	parser.add_argument('--probes', type = int, default = 64)
+	parser.add_argument('--chunk-size', type = int, default = CHUNK_SIZE)
+	parser.add_argument('-k', type = int, default = 5)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = args.gallery
+		if path is None:
+			start = time.time()
+			gallery = synthetic_gallery(args.synthetic)
+			path = os.path.join(directory, 'synthetic.bin')
+			write_gallery_store(path, gallery, ['synthetic/%d' % index for index in range(len(gallery))])
+			print('synthetic gallery: %d templates, %d minutiae, %.1fs' % (
+				len(gallery), sum(len(gallery.owner[t]) for t in MINUTIAE_TYPES), time.time() - start))
+		else:
+			gallery = open_gallery(path)
+		probes = synthetic_probes(gallery, args.probes)
+
+		print('cpu count: %s' % os.cpu_count())
+		baseline = None
+		for workers in args.workers:
+			with ShardedSearch(path, workers = workers, shards = args.shards, chunk_size = args.chunk_size) as search:
+				search.search(probes[:1], args.k)
+				start = time.time()
+				search.search(probes, args.k)
+				throughput = len(probes) / (time.time() - start)
+			baseline = baseline or throughput
+			print('workers %2d: %8.2f probes/s, speedup %.2f' % (workers, throughput, throughput / baseline))
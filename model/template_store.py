@@ -0,0 +1,210 @@
+"""
+Binary gallery store, the columnar replacement of db_data.json.
+
+The file is made of fixed size sections read with np.memmap, so opening it costs the same whatever the size of
+the gallery and several matcher processes mapping the same file share its pages:
+
+    header          72 bytes: magic, version, number of minutiae types, number of templates,
+                    size of the string table, grid cell size, number of minutiae of every type
+    name_offsets    (n_templates + 1,) int64, offsets of every image id in the string table
+    names           utf-8 string table of the image ids, padded to 8 bytes
+    classes         (n_templates,) uint8 pattern class of every template (PATTERN_CLASSES code, 255 when the
+                    template was not classified), padded to 8 bytes; missing in version 2 files
+    for every minutiae type, rows grouped by template and sorted by grid cell (the layout of MinutiaeGallery):
+        offsets     (n_templates + 1,) int64, first row of every template
+        points      (n, 3) float64, x, y, angle (NaN for a missing angle)
+        owner       (n,) int64, template index of every row
+        cells       (n,) int64, template_grid_keys of every row, the spatial grid index of the templates
+        position    (n,) int32, index of the minutiae in its template, padded to 8 bytes
+
+The conversion from and to the db_data.json list of {'img': ..., 'points': [[type, x, y, angle], ...], 'class': ...}
+keeps every value: coordinates come back as ints when they are whole numbers (as written by the extractor) and as
+the stored floats otherwise. The records compare equal, the JSON text itself is not reformatted like db_data.json.
+"""
+import json
+import os
+import struct
+import sys
+import numpy as np
+from .matching import MinutiaeGallery, MINUTIAE_TYPES, GRID_CELL_SIZE, grid_keys, template_grid_keys
+from .pattern_class import PATTERN_CLASSES
+
+MAGIC = b'FPGALLRY'
+VERSION = 3
+READ_VERSIONS = (2, 3)
+UNCLASSIFIED = 255
+HEADER = struct.Struct('<8sII QQ d 4Q')
+
+
+def _padding(size):
+	return -size % 8
+
+
+def _coordinate(value):
+	return int(value) if value.is_integer() else value
+
+
+def _write_store(path, names, sections, cell_size, classes = None):
+	"""
+	:param names: list of the utf-8 encoded image ids
+	:param classes: class code of every template, UNCLASSIFIED by default
+	:param sections: for every minutiae type, (offsets, points, owner, cells, position) in the file layout
+	"""
+	name_offsets = np.concatenate([[0], np.cumsum([len(name) for name in names])]).astype(np.int64)
+	string_table = b''.join(names)
+	counts = [len(section[1]) for section in sections]
+	classes = np.full(len(names), UNCLASSIFIED, dtype = np.uint8) if classes is None else \
+		np.asarray(classes, dtype = np.uint8)
+
+	tmp_path = str(path) + '.tmp'
+	with open(tmp_path, mode = 'wb') as f:
+		f.write(HEADER.pack(MAGIC, VERSION, len(MINUTIAE_TYPES), len(names), len(string_table), cell_size,
+							*(counts + [0] * (4 - len(counts)))))
+		f.write(name_offsets.tobytes())
+		f.write(string_table + b'\0' * _padding(len(string_table)))
+		f.write(classes.tobytes() + b'\0' * _padding(classes.nbytes))
+		for offsets, points, owner, cells, position in sections:
+			f.write(np.ascontiguousarray(offsets, dtype = np.int64).tobytes())
+			f.write(np.ascontiguousarray(points, dtype = np.float64).tobytes())
+			f.write(np.ascontiguousarray(owner, dtype = np.int64).tobytes())
+			f.write(np.ascontiguousarray(cells, dtype = np.int64).tobytes())
+			position = np.ascontiguousarray(position, dtype = np.int32)
+			f.write(position.tobytes() + b'\0' * _padding(position.nbytes))
+	os.replace(tmp_path, path)
+
+
+def write_template_store(path, data, cell_size = GRID_CELL_SIZE):
+	"""
+	Write the db_data.json records to a binary store. The file is written next to path and renamed, so readers
+	never see a partially written gallery.
+	:param data: list of {'img': ..., 'points': [[type, x, y, angle], ...]}, with the 'class' name when classified
+	:param cell_size: cell size of the grid index built for every template
+	"""
+	sections = []
+	for minutiae_type in MINUTIAE_TYPES:
+		rows = [(index, position, point) for index, record in enumerate(data)
+				for position, point in enumerate(record['points']) if point[0] == minutiae_type]
+		owner = np.array([row[0] for row in rows], dtype = np.int64)
+		position = np.array([row[1] for row in rows], dtype = np.int32)
+		points = np.array([[row[2][1], row[2][2], np.nan if row[2][3] is None else row[2][3]] for row in rows],
+						  dtype = np.float64).reshape(-1, 3)
+		cells = template_grid_keys(owner, grid_keys(points[:, :2], cell_size))
+		order = np.argsort(cells, kind = 'stable')
+		offsets = np.searchsorted(owner, np.arange(len(data) + 1)).astype(np.int64)
+		sections.append((offsets, points[order], owner, cells[order], position[order]))
+	classes = [PATTERN_CLASSES.index(record['class']) if 'class' in record else UNCLASSIFIED for record in data]
+	_write_store(path, [record['img'].encode('utf-8') for record in data], sections, cell_size, classes)
+
+
+def write_gallery_store(path, gallery, names, classes = None):
+	"""
+	Write a MinutiaeGallery with a grid index (e.g. built from arrays, without db_data.json records) to a binary
+	store. The minutiae of a template are numbered type by type in the gallery row order.
+	:param names: image id of every template
+	:param classes: class code of every template, UNCLASSIFIED by default
+	"""
+	sections = []
+	before = np.zeros(len(gallery), dtype = np.int64)
+	for minutiae_type in MINUTIAE_TYPES:
+		offsets = gallery.offsets[minutiae_type]
+		owner = gallery.owner[minutiae_type]
+		position = np.arange(len(owner)) - offsets[owner] + before[owner]
+		before += np.diff(offsets)
+		sections.append((offsets, gallery.points[minutiae_type], owner, gallery.cells[minutiae_type], position))
+	_write_store(path, [name.encode('utf-8') for name in names], sections, gallery.cell_size, classes)
+
+
+def open_gallery(path):
+	"""
+	MinutiaeGallery of a binary store (memory mapped) or of a db_data.json file.
+	"""
+	if str(path).endswith('.json'):
+		return MinutiaeGallery.from_json(path)
+	return TemplateStore(path).gallery()
+
+
+class TemplateStore(object):
+	"""
+	Read only view of a binary gallery store. store[i] rebuilds the db_data.json record of template i.
+	"""
+	def __init__(self, path):
+		self.path = path
+		with open(path, mode = 'rb') as f:
+			header = HEADER.unpack(f.read(HEADER.size))
+		magic, version, n_types, n_templates, string_bytes, self.cell_size = header[:6]
+		if magic != MAGIC or version not in READ_VERSIONS:
+			raise ValueError('%s is not a template store' % path)
+		counts = header[6:6 + n_types]
+
+		position = HEADER.size
+		def section(dtype, shape):
+			nonlocal position
+			array = np.memmap(path, dtype = dtype, mode = 'r', offset = position, shape = shape) \
+				if int(np.prod(shape)) else np.zeros(shape, dtype = dtype)
+			position += int(np.prod(shape)) * np.dtype(dtype).itemsize
+			position += _padding(position)
+			return array
+
+		self.name_offsets = section(np.int64, (n_templates + 1,))
+		self.names = section(np.uint8, (string_bytes,))
+		self.classes = section(np.uint8, (n_templates,)) if version >= 3 else \
+			np.full(n_templates, UNCLASSIFIED, dtype = np.uint8)
+		self.offsets, self.points, self.owner, self.cells, self.position = {}, {}, {}, {}, {}
+		for minutiae_type, count in zip(MINUTIAE_TYPES, counts):
+			self.offsets[minutiae_type] = section(np.int64, (n_templates + 1,))
+			self.points[minutiae_type] = section(np.float64, (count, 3))
+			self.owner[minutiae_type] = section(np.int64, (count,))
+			self.cells[minutiae_type] = section(np.int64, (count,))
+			self.position[minutiae_type] = section(np.int32, (count,))
+
+	def __len__(self):
+		return len(self.name_offsets) - 1
+
+	def image_id(self, index):
+		return bytes(self.names[self.name_offsets[index]:self.name_offsets[index + 1]]).decode('utf-8')
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError(index)
+		points = []
+		for minutiae_type in MINUTIAE_TYPES:
+			rows = slice(self.offsets[minutiae_type][index], self.offsets[minutiae_type][index + 1])
+			for position, (x, y, angle) in zip(self.position[minutiae_type][rows].tolist(),
+											   self.points[minutiae_type][rows].tolist()):
+				points.append((position, [minutiae_type, _coordinate(x), _coordinate(y),
+										  None if angle != angle else angle]))
+		points.sort(key = lambda point: point[0])
+		record = {'img': self.image_id(index), 'points': [point for _, point in points]}
+		if self.classes[index] != UNCLASSIFIED:
+			record['class'] = PATTERN_CLASSES[self.classes[index]]
+		return record
+
+	def records(self):
+		return [self[index] for index in range(len(self))]
+
+	def gallery(self):
+		"""
+		MinutiaeGallery over the mapped arrays, without copying them.
+		"""
+		return MinutiaeGallery(self.points, self.owner, self.offsets, self, self.cells, self.cell_size)
+
+
+def json_to_store(json_path, store_path):
+	with open(json_path, mode = 'r') as f:
+		write_template_store(store_path, json.load(f))
+
+
+def store_to_json(store_path, json_path):
+	with open(json_path, mode = 'w') as f:
+		json.dump(TemplateStore(store_path).records(), f)
+
+
+if __name__ == '__main__':
+	# python -m model.template_store data/dataset/db_data.json data/dataset/db_data.bin (or the other way round)
+	source, target = sys.argv[1:3]
+	if source.endswith('.json'):
+		json_to_store(source, target)
+	else:
+		store_to_json(source, target)
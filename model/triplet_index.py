@@ -0,0 +1,232 @@
+"""
+Inverted index over minutiae triplets, the coarse stage of 1:N identification.
+
+Every template is turned into triangles of nearby minutiae. A triangle is described by features that do not change
+when the finger is moved or rotated: its quantized side lengths, the direction of each minutiae against the side
+leaving it and the minutiae types, taken in a canonical vertex order (longest opposite side first). The integer
+key of every triangle points to the templates containing it; a probe votes for the templates sharing its keys and
+only the best voted candidates are scored by the full matcher (MinutiaeGallery).
+
+    python -m model.triplet_index [gallery.json] [test directory]
+
+prints the recall of the candidate list against its length on the test split.
+"""
+import json
+import sys
+import time
+from math import pi
+import numpy as np
+from .matching import pack_minutiaes, MinutiaeGallery
+from .minunate_detection import direction_angles
+
+TRIPLET_NEIGHBOURS = 4
+SIDE_STEP = 12
+MAX_SIDE = 160
+ANGLE_BINS = 8
+_SIDE_BITS = 4
+_ANGLE_BITS = 3
+
+
+def minutiae_triplets(xy, neighbours = TRIPLET_NEIGHBOURS):
+	"""
+	Triangles made by every point and two of its nearest neighbours.
+	:param xy: (n, 2) array of points
+	:return: (t, 3) int array of point indexes, every triangle once
+	"""
+	n = len(xy)
+	if n < 3:
+		return np.zeros((0, 3), dtype = np.int64)
+	k = min(neighbours, n - 1)
+	distance = np.hypot(xy[:, np.newaxis, 0] - xy[np.newaxis, :, 0], xy[:, np.newaxis, 1] - xy[np.newaxis, :, 1])
+	np.fill_diagonal(distance, np.inf)
+	nearest = np.argsort(distance, axis = 1, kind = 'stable')[:, :k]
+	first, second = np.triu_indices(k, 1)
+	triplets = np.stack([np.repeat(np.arange(n), len(first)), nearest[:, first].ravel(), nearest[:, second].ravel()],
+						axis = 1)
+	return np.unique(np.sort(triplets, axis = 1), axis = 0)
+
+
+def triplet_keys(points, neighbours = TRIPLET_NEIGHBOURS, side_step = SIDE_STEP, max_side = MAX_SIDE,
+				 angle_bins = ANGLE_BINS):
+	"""
+	Rotation and translation invariant keys of the minutiae triangles of a template.
+	:param points: list of [type, x, y, angle] or (n, 4) array; minutiae without angle are left out
+	:param side_step: length quantization step of the sides
+	:param max_side: triangles with a longer side are dropped, the distortion of the finger makes them unstable
+	:param angle_bins: quantization of the minutiae directions, relative to the sides
+	:return: sorted array of the distinct int64 keys
+	"""
+	points = pack_minutiaes(points) if not isinstance(points, np.ndarray) else points
+	points = points[~np.isnan(points[:, 3])]
+	triplets = minutiae_triplets(points[:, 1:3], neighbours)
+	if len(triplets) == 0:
+		return np.zeros(0, dtype = np.int64)
+	vertices = points[triplets]
+
+	# side i is the side opposite to vertex i
+	sides = np.stack([np.hypot(*(vertices[:, (i + 1) % 3, 1:3] - vertices[:, (i + 2) % 3, 1:3]).T)
+					  for i in range(3)], axis = 1)
+	order = np.argsort(-sides, axis = 1, kind = 'stable')
+	vertices = np.take_along_axis(vertices, order[:, :, np.newaxis], axis = 1)
+	sides = np.take_along_axis(sides, order, axis = 1)
+	valid = sides[:, 0] <= max_side
+	vertices = vertices[valid]; sides = sides[valid]
+
+	# direction of every minutiae against the side going to the next vertex
+	edges = np.roll(vertices[:, :, 1:3], -1, axis = 1) - vertices[:, :, 1:3]
+	edge_angles = direction_angles(edges.reshape(-1, 2)).reshape(-1, 3)
+	relative = np.mod(vertices[:, :, 3] - edge_angles, 2*pi)
+	angles = np.minimum((relative * angle_bins / (2*pi)).astype(np.int64), angle_bins - 1)
+	lengths = np.minimum((sides / side_step).astype(np.int64), (1 << _SIDE_BITS) - 1)
+	types = vertices[:, :, 0].astype(np.int64)
+
+	keys = np.zeros(len(vertices), dtype = np.int64)
+	for i in range(3):
+		keys = (keys << _SIDE_BITS) | lengths[:, i]
+		keys = (keys << _ANGLE_BITS) | angles[:, i]
+		keys = (keys << 1) | types[:, i]
+	return np.unique(keys)
+
+
+class TripletIndex(object):
+	"""
+	Inverted index: the sorted keys of all templates and, for every entry, the template holding it.
+	"""
+	def __init__(self, keys, postings, counts, records, params = None):
+		"""
+		:param keys: (p,) sorted int64 keys
+		:param postings: (p,) template index of every key
+		:param counts: (n_templates,) number of distinct keys of every template
+		:param records: sequence with one object per template
+		:param params: triplet_keys arguments the keys were built with, used for the probes too
+		"""
+		self.keys = keys
+		self.postings = postings
+		self.counts = counts
+		self.records = records
+		self.params = params or {}
+
+	@classmethod
+	def from_templates(cls, templates, records = None, **kwargs):
+		"""
+		:param templates: list of templates, each one a list of [type, x, y, angle]
+		:param kwargs: passed to triplet_keys
+		"""
+		records = records if records is not None else list(range(len(templates)))
+		per_template = [triplet_keys(points, **kwargs) for points in templates]
+		counts = np.array([len(keys) for keys in per_template], dtype = np.int64)
+		keys = np.concatenate(per_template) if per_template else np.zeros(0, dtype = np.int64)
+		postings = np.repeat(np.arange(len(templates)), counts)
+		order = np.argsort(keys, kind = 'stable')
+		return cls(keys[order], postings[order], counts, records, kwargs)
+
+	@classmethod
+	def from_records(cls, data, **kwargs):
+		return cls.from_templates([record['points'] for record in data], records = data, **kwargs)
+
+	@classmethod
+	def from_json(cls, path, **kwargs):
+		with open(path, mode = 'r') as f:
+			return cls.from_records(json.load(f), **kwargs)
+
+	def __len__(self):
+		return len(self.records)
+
+	def votes(self, probe):
+		"""
+		Number of the probe keys found in every template.
+		:return: (n_templates,) int array
+		"""
+		probe_keys = triplet_keys(probe, **self.params)
+		begin = np.searchsorted(self.keys, probe_keys, side = 'left')
+		end = np.searchsorted(self.keys, probe_keys, side = 'right')
+		lengths = end - begin
+		rows = np.repeat(begin - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+		return np.bincount(self.postings[rows], minlength = len(self))
+
+	def candidates(self, probe, n):
+		"""
+		The n templates with the most votes relative to their number of keys, so that large templates do not
+		collect votes by chance, best first.
+		:return: array of template indexes
+		"""
+		score = self.votes(probe) / np.maximum(self.counts, 1)
+		return np.argsort(-score, kind = 'stable')[:n]
+
+	def search(self, probe, gallery, n, k = 1, **kwargs):
+		"""
+		Full matching restricted to the n candidates of the index.
+		:param gallery: MinutiaeGallery of the same templates
+		:return: list of (template index, score), best first, like MinutiaeGallery.search
+		"""
+		candidates = self.candidates(probe, n)
+		scores = gallery.subset(candidates).scores(probe, **kwargs)
+		order = np.argsort(-scores, kind = 'stable')[:k]
+		return [(int(candidates[index]), int(scores[index])) for index in order]
+
+
+def candidate_ranks(index, probes, relevant):
+	"""
+	Position of the first relevant template in the candidate list of every probe (len(index) when there is none).
+	:param probes: list of templates
+	:param relevant: list with, for every probe, the set of relevant template indexes
+	"""
+	ranks = []
+	for probe, targets in zip(probes, relevant):
+		order = index.candidates(probe, len(index))
+		hits = np.flatnonzero(np.isin(order, list(targets)))
+		ranks.append(int(hits[0]) if len(hits) else len(index))
+	return np.array(ranks, dtype = np.int64)
+
+
+def recall_curve(ranks, sizes):
+	"""
+	Fraction of the probes whose relevant template is among the first n candidates, for every n of sizes.
+	"""
+	return [(int(n), float(np.mean(ranks < n))) for n in sizes]
+
+
+if __name__ == '__main__':
+	# python -m model.triplet_index data/dataset/db_data.json data/dataset/test
+	from .extraction import extract_template, split_images, finger_id, TEST_PATH
+	gallery_path = sys.argv[1] if len(sys.argv) > 1 else './data/dataset/db_data.json'
+	test_path = sys.argv[2] if len(sys.argv) > 2 else TEST_PATH
+	with open(gallery_path, mode = 'r') as f:
+		data = json.load(f)
+	start = time.time()
+	index = TripletIndex.from_records(data)
+	print('index: %d templates, %d keys, %.2fs' % (len(index), len(index.keys), time.time() - start))
+	gallery = MinutiaeGallery.from_records(data)
+	fingers = [finger_id(record['img']) for record in data]
+
+	images = split_images(test_path)
+	probes = [extract_template(test_path + '/' + image) for image in images]
+	# two references: any impression of the probe finger, and the template picked by the full matcher
+	mates = [set(i for i, finger in enumerate(fingers) if finger == finger_id(image)) for image in images]
+	full_best = [{gallery.search(probe)[0][0]} for probe in probes]
+
+	sizes = [n for n in (1, 2, 5, 10, 20, 50, 100, 200) if n < len(index)] + [len(index)]
+	curves = {}
+	for database in sorted(set(image.split('/')[0] for image in images)):
+		selected = [i for i, image in enumerate(images) if image.startswith(database + '/')]
+		curves[database] = recall_curve(candidate_ranks(index, [probes[i] for i in selected],
+														[mates[i] for i in selected]), sizes)
+	curves['all / mate'] = recall_curve(candidate_ranks(index, probes, mates), sizes)
+	curves['all / full matcher top-1'] = recall_curve(candidate_ranks(index, probes, full_best), sizes)
+	# accuracy of the two stage search: rank 1 of the full matcher over the n candidates
+	curves['all / rank-1 after matcher'] = [(n, float(np.mean([index.search(probe, gallery, n)[0][0] in targets
+															   for probe, targets in zip(probes, mates)])))
+											for n in sizes]
+	print('N'.ljust(28) + ''.join(str(n).rjust(7) for n in sizes))
+	for name, curve in curves.items():
+		print(name.ljust(28) + ''.join(('%.3f' % recall).rjust(7) for _, recall in curve))
+
+	start = time.time()
+	for probe in probes:
+		index.votes(probe)
+	vote_time = (time.time() - start) / len(probes)
+	start = time.time()
+	for probe in probes:
+		gallery.scores(probe)
+	full_time = (time.time() - start) / len(probes)
+	print('per probe: votes %.2f ms, full matcher %.2f ms' % (vote_time * 1e3, full_time * 1e3))
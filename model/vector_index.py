@@ -0,0 +1,91 @@
+"""
+Exact nearest neighbour index over fixed length print embeddings (orientation field, CNN features), the candidate
+generator in front of the minutiae matcher: the unit vectors of the gallery are the rows of one contiguous float32
+matrix, possibly memory mapped from a .npy file, and a batch of queries is answered by one matrix product.
+"""
+import numpy as np
+
+SHORTLIST = 20
+
+
+def normalize_rows(vectors):
+	"""
+	Rows scaled to unit length, zero rows left as they are.
+	"""
+	vectors = np.asarray(vectors, dtype = np.float32)
+	norms = np.linalg.norm(vectors, axis = -1, keepdims = True)
+	return np.divide(vectors, norms, out = np.zeros_like(vectors), where = norms > 0)
+
+
+class VectorIndex(object):
+	"""
+	One row per template, compared by dot product (the cosine similarity of unit vectors).
+	"""
+	def __init__(self, vectors, records = None):
+		"""
+		:param vectors: (n_templates, d) float32 matrix of unit vectors
+		:param records: sequence with one object per template, the template index by default
+		"""
+		# a contiguous float32 memory map is used as it is, without copying
+		self.vectors = np.ascontiguousarray(vectors, dtype = np.float32)
+		self.records = records if records is not None else list(range(len(vectors)))
+
+	def save(self, path):
+		np.save(path, self.vectors)
+
+	@classmethod
+	def load(cls, path, records = None):
+		"""
+		Index over a matrix written by save, memory mapped.
+		"""
+		return cls(np.load(path, mmap_mode = 'r'), records)
+
+	def __len__(self):
+		return len(self.vectors)
+
+	def similarities(self, embedding):
+		"""
+		:return: (n_templates,) float32 similarity of every template, 1 for identical embeddings
+		"""
+		return self.vectors @ np.asarray(embedding, dtype = np.float32)
+
+	def shortlist(self, embedding, n = SHORTLIST):
+		"""
+		The n most similar templates, best first.
+		:return: array of template indexes
+		"""
+		return self.knn(np.asarray(embedding)[np.newaxis], n)[0][0]
+
+	def knn(self, embeddings, k = SHORTLIST):
+		"""
+		k nearest templates of a batch of queries, with one matrix product.
+		:param embeddings: (q, d) queries
+		:return: ((q, k) template indexes best first, (q, k) similarities)
+		"""
+		similarity = np.asarray(embeddings, dtype = np.float32) @ self.vectors.T
+		k = min(k, len(self))
+		if k == 0:
+			return np.zeros((len(similarity), 0), dtype = np.int64), np.zeros((len(similarity), 0), dtype = np.float32)
+		nearest = np.argpartition(-similarity, k - 1, axis = 1)[:, :k]
+		order = np.argsort(-np.take_along_axis(similarity, nearest, axis = 1), axis = 1, kind = 'stable')
+		nearest = np.take_along_axis(nearest, order, axis = 1)
+		return nearest, np.take_along_axis(similarity, nearest, axis = 1)
+
+	def search(self, embedding, probe, gallery, n = SHORTLIST, k = 1, **kwargs):
+		"""
+		Minutiae matching restricted to the shortlist of the probe embedding.
+		:param probe: minutiae of the probe, list of [type, x, y, angle] or (m, 4) array
+		:param gallery: MinutiaeGallery of the same templates
+		:return: list of (template index, score), best first, like MinutiaeGallery.search
+		"""
+		candidates = self.shortlist(embedding, n)
+		scores = gallery.subset(candidates).scores(probe, **kwargs)
+		order = np.argsort(-scores, kind = 'stable')[:k]
+		return [(int(candidates[index]), int(scores[index])) for index in order]
+
+
+def random_embeddings(n, dimension, seed = 0):
+	"""
+	Unit float32 vectors to time queries on galleries larger than the dataset.
+	"""
+	return normalize_rows(np.random.default_rng(seed).standard_normal((n, dimension), dtype = np.float32))
@@ -39,36 +39,16 @@ def main1(path):
 
 # tìm minuntiae cho toàn bộ data
 def main(path):
-	w = 16
-	image = read_image_rgb(path)
-	image = normalize(image,m0 = float(100), v0 = float(100))
-	image_segment,norm_img,mask = create_segmented_and_variance_images(image, w = w, threshold=.4)
-	image_oriented = calculate_angles(image_segment,w)
-	freq = ridge_freq(norm_img, mask, image_oriented, w, kernel_size = 5, minWaveLength = 5, maxWaveLength = 15)
-	gabor_img = gabor_filter(norm_img, image_oriented, freq)
-	image_thinning = skeletonize(gabor_img)
-	list_point_minunate,result_im = get_minunatiaes_point(image_thinning)
-	result = []
-	for i in list_point_minunate:
-		result.append([i[0], i[1][0], i[1][1], i[2]])
-	return result
+	return extract_template(path)
 
 def search_image(I, data):
-	no_max = 0
-	point = []
-	for T in data:
-		check = np.zeros(len(T['points']))
-		count = 0
-		for mi in I:
-			for i, mt in enumerate(T['points']):
-				(sd, dd) = calculate_distance(mt, mi)
-				if check[i] == 0 and mt[0] == mi[0] and sd < 50 and dd < pi/24:
-					count += 1
-					check[i] = 1
-		if(no_max < count):
-			no_max = count
-			point = T
-	return (point, no_max)
+	# data: danh sách trong db_data.json hoặc MinutiaeGallery đã đóng gói sẵn,
+	# top-k: MinutiaeGallery.identify(I, k) (bỏ qua các template có cận trên không đủ để vào top-k)
+	gallery = data if isinstance(data, MinutiaeGallery) else MinutiaeGallery.from_records(data)
+	(index, no_max) = gallery.identify(I, k = 1)[0][0] if len(gallery) else (None, 0)
+	if no_max == 0:
+		return ([], 0)
+	return (gallery.records[index], no_max)
 
 
 def path_tokenizer(source, rel):
@@ -78,29 +58,8 @@ def path_tokenizer(source, rel):
 		return True
 	return False
 
-# test_path = 'D:/My Document/HK8/HeCSDLDPT/BTL/fingerprint-recognization/f/data/dataset/test/DB'
-# data_path = './data/dataset/db_data.json'
-# data = []
-# with open(data_path, mode='r') as f:
-# 	data = json.load(f)
-# result = './data/dataset/result.txt'
-# rel_file = open(result, mode='w')
-# count = 0
-# hit_point = 0
-# for i in range(1, 5):
-# 	tmp_path = test_path + str(i)
-# 	list_test = os.listdir(tmp_path)
-# 	for test in list_test:
-# 		count += 1
-# 		img_path = tmp_path + "/" + test
-# 		print(img_path)
-# 		I = main(img_path)
-# 		(point, no_max) = search_image(I, data)
-# 		rel_file.write(img_path + " - " + str(point) + ' - ' + str(no_max) + '\n')
-# 		if(path_tokenizer(img_path, point['img'])):
-# 			hit_point += 1
-# print(hit_point, count)
-# rel_file.close()
+# đánh giá rank-1/rank-k, độ trễ từng bước và thông lượng trên tập test DB1-DB4 (song song, xuất JSON):
+# python -m model.evaluation --workers 4 --output ./data/dataset/evaluation.json
 
 
 #print('Mời nhập link ảnh: ')
@@ -108,12 +67,17 @@ input_path = input('Mời nhập link ảnh: ')
 
 start = time.time()
 data_path = './data/dataset/db_data.json'
-data = []
-with open(data_path, mode='r') as f:
- 	data = json.load(f)
+store_path = './data/dataset/db_data.bin'
+# ưu tiên gallery nhị phân (python -m model.template_store db_data.json db_data.bin), mở bằng memmap
+if os.path.exists(store_path):
+	gallery = TemplateStore(store_path).gallery()
+else:
+	with open(data_path, mode='r') as f:
+	 	data = json.load(f)
+	gallery = MinutiaeGallery.from_records(data)
 
 I = main(input_path)
-(point, no_max) = search_image(I, data)
+(point, no_max) = search_image(I, gallery)
 print(time.time()-start)
 img = read_image_rgb('./data/dataset/train/' + point['img'])
 print('./data/dataset/train/' + point['img'])
@@ -14,11 +14,21 @@ from utils import orientation
 from utils.frequency import ridge_freq
 from utils.gabor_filter import gabor_filter
 from utils.skeletonize import skeletonize
-from utils.crossing_number import calculate_minutiaes
-from utils.poincare import calculate_singularities
+from utils.crossing_number import extract_minutiaes, draw_minutiaes, minutiaes_to_list
+from utils.poincare import detect_singularities, draw_singularities
+from model.identification import IdentificationService, claim_finger, parse_top_k
 
 PORT = 8080
 
+# gallery nạp một lần khi khởi động server, dùng chung cho mọi request /api/identify, /api/verify
+identification_service = None
+
+def get_identification_service():
+    global identification_service
+    if identification_service is None:
+        identification_service = IdentificationService()
+    return identification_service
+
 def image_to_base64(img):
     """Chuyển ảnh numpy array sang base64 string"""
     # Đảm bảo ảnh là uint8
@@ -72,7 +82,7 @@ def process_fingerprint(input_img):
     })
     
     # BƯỚC 4: Định hướng
-    angles = orientation.calculate_angles(normalized_img, W=block_size, smoth=False)
+    angles, coherence = orientation.calculate_angles(normalized_img, W=block_size, smoth=False, return_coherence=True)
     orientation_img = orientation.visualize_angles(segmented_img, mask, angles, W=block_size)
     steps.append({
         'step': 4,
@@ -107,24 +117,28 @@ def process_fingerprint(input_img):
     })
     
     # BƯỚC 7: Điểm đặc trưng (Minutiae)
-    minutias_img = calculate_minutiaes(thin_image)
+    minutiaes = extract_minutiaes(thin_image, angles=angles, coherence=coherence, W=block_size)
+    minutias_img = draw_minutiaes(thin_image, minutiaes)
     steps.append({
         'step': 7,
         'name': '🔴🟢 Minutiae (Điểm đặc trưng)',
         'description': 'Phát hiện các điểm đặc trưng minutiae - những điểm quan trọng nhất để nhận dạng vân tay. Có 2 loại: Ridge Ending (điểm kết thúc - màu ĐỎ) và Bifurcation (điểm phân nhánh - màu XANH LÁ). Sử dụng phương pháp Crossing Number.',
         'image': image_to_base64(minutias_img),
-        'details': '🔴 Ridge Ending (CN=1) | 🟢 Bifurcation (CN=3) | 📊 Trung bình: 40-60 minutiae/ảnh | 💾 Lưu: (type, x, y, θ)',
+        'details': f'🔴 Ridge Ending (CN=1) | 🟢 Bifurcation (CN=3) | 📊 Tìm được: {len(minutiaes)} minutiae | 💾 Lưu: (type, x, y, θ)',
+        'minutiae': minutiaes_to_list(minutiaes),
         'legend': '<span style="color: red; font-weight: bold;">● Ridge Ending (Đỏ)</span> &nbsp;&nbsp; <span style="color: green; font-weight: bold;">● Bifurcation (Xanh)</span>'
     })
     
     # BƯỚC 8: Điểm kỳ dị (Singularities)
-    singularities_img = calculate_singularities(thin_image, angles, 1, block_size, mask)
+    singularities = detect_singularities(angles, 1, block_size, mask)
+    singularities_img = draw_singularities(thin_image, singularities, block_size)
     steps.append({
         'step': 8,
         'name': '🟠 Singularities (Điểm kỳ dị)',
         'description': 'Phát hiện các điểm kỳ dị (Core, Delta, Whorl) - những điểm mà hướng vân tay thay đổi đột ngột. Core là tâm xoáy (ô vuông CAM), Delta là điểm tam giác (ô vuông ĐỎ), Whorl là điểm xoáy (ô vuông TÍM). Bước này CHỈ ĐỂ TRỰC QUAN HÓA, không dùng cho matching.',
         'image': image_to_base64(singularities_img),
         'details': '🟧 Core (Cam) | 🟥 Delta (Đỏ) | 🟪 Whorl (Tím) | ℹ️ Chỉ để hiển thị, không dùng matching',
+        'singularities': [{'type': singularity, 'x': x, 'y': y} for singularity, (x, y) in singularities],
         'legend': '<span style="display:inline-block;width:18px;height:18px;border:2px solid orange;vertical-align:middle;margin-right:4px;"></span> Core (Cam) &nbsp;&nbsp;'
                   '<span style="display:inline-block;width:18px;height:18px;border:2px solid red;vertical-align:middle;margin-right:4px;"></span> Delta (Đỏ) &nbsp;&nbsp;'
                   '<span style="display:inline-block;width:18px;height:18px;border:2px solid purple;vertical-align:middle;margin-right:4px;"></span> Whorl (Tím)'
@@ -168,6 +182,12 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if self.path == '/api/process':
             self.handle_upload()
             return
+        if self.path == '/api/identify':
+            self.handle_identify()
+            return
+        if self.path == '/api/verify':
+            self.handle_verify()
+            return
         self.send_response(404)
         self.send_header('Content-type', 'application/json')
         self.end_headers()
@@ -203,48 +223,108 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_json_response({'error': str(e)}, 500)
     
+    def read_multipart(self):
+        """Đọc multipart form data: trả về (ảnh xám, các trường text); gửi lỗi 400 và trả về None nếu không hợp lệ"""
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
+        
+        # Parse multipart form data - tìm boundary
+        content_type = self.headers.get('Content-Type', '')
+        if 'boundary=' not in content_type:
+            self.send_json_response({'error': 'Invalid content type'}, 400)
+            return None
+            
+        boundary = content_type.split('boundary=')[1].encode()
+        parts = post_data.split(b'--' + boundary)
+        
+        image_data = None
+        fields = {}
+        for part in parts:
+            if b'Content-Type: image' in part or b'filename=' in part:
+                if image_data is not None and len(image_data) > 100:
+                    continue
+                try:
+                    # Tách header và data
+                    headers_and_data = part.split(b'\r\n\r\n', 1)
+                    if len(headers_and_data) == 2:
+                        image_data = headers_and_data[1].rstrip(b'\r\n')
+                except:
+                    continue
+            elif b'name="' in part:
+                # Trường text (vd. claim, k)
+                headers_and_data = part.split(b'\r\n\r\n', 1)
+                if len(headers_and_data) == 2:
+                    name = headers_and_data[0].split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                    fields[name] = headers_and_data[1].rstrip(b'\r\n').decode('utf-8', 'replace')
+        
+        if image_data is None or len(image_data) < 100:
+            self.send_json_response({'error': 'Không tìm thấy ảnh trong request'}, 400)
+            return None
+        
+        # Decode ảnh
+        nparr = np.frombuffer(image_data, np.uint8)
+        input_img = cv.imdecode(nparr, cv.IMREAD_GRAYSCALE)
+        
+        if input_img is None:
+            self.send_json_response({'error': 'Không thể đọc ảnh. Vui lòng upload file ảnh hợp lệ'}, 400)
+            return None
+        return input_img, fields
+    
     def handle_upload(self):
         """Xử lý upload ảnh"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Parse multipart form data - tìm boundary
-            content_type = self.headers.get('Content-Type', '')
-            if 'boundary=' not in content_type:
-                self.send_json_response({'error': 'Invalid content type'}, 400)
+            upload = self.read_multipart()
+            if upload is None:
                 return
-                
-            boundary = content_type.split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
+            input_img, _ = upload
             
-            image_data = None
-            for part in parts:
-                if b'Content-Type: image' in part or b'filename=' in part:
-                    try:
-                        # Tách header và data
-                        headers_and_data = part.split(b'\r\n\r\n', 1)
-                        if len(headers_and_data) == 2:
-                            image_data = headers_and_data[1].rstrip(b'\r\n')
-                            if len(image_data) > 100:  # Đảm bảo có data
-                                break
-                    except:
-                        continue
+            steps = process_fingerprint(input_img)
+            self.send_json_response({'success': True, 'steps': steps})
             
-            if image_data is None or len(image_data) < 100:
-                self.send_json_response({'error': 'Không tìm thấy ảnh trong request'}, 400)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.send_json_response({'error': f'Lỗi server: {str(e)}'}, 500)
+    
+    def handle_identify(self):
+        """Nhận dạng 1:N: top-k template khớp nhất trong gallery, kèm thời gian từng bước"""
+        try:
+            upload = self.read_multipart()
+            if upload is None:
+                return
+            input_img, fields = upload
+            k = parse_top_k(fields.get('k'))
+            if k is None:
+                self.send_json_response({'error': 'Trường k phải là số nguyên dương'}, 400)
                 return
             
-            # Decode ảnh
-            nparr = np.frombuffer(image_data, np.uint8)
-            input_img = cv.imdecode(nparr, cv.IMREAD_GRAYSCALE)
+            result = get_identification_service().identify(input_img, k)
+            self.send_json_response({'success': True, **result})
             
-            if input_img is None:
-                self.send_json_response({'error': 'Không thể đọc ảnh. Vui lòng upload file ảnh hợp lệ'}, 400)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.send_json_response({'error': f'Lỗi server: {str(e)}'}, 500)
+    
+    def handle_verify(self):
+        """Xác thực 1:1: so ảnh với các template của ngón tay được khai báo (trường claim, vd. DB1/101)"""
+        try:
+            upload = self.read_multipart()
+            if upload is None:
+                return
+            input_img, fields = upload
+            if not fields.get('claim'):
+                self.send_json_response({'error': 'Thiếu trường claim (mã ngón tay, vd. DB1/101)'}, 400)
+                return
+            if claim_finger(fields['claim']) is None:
+                self.send_json_response({'error': f'claim không hợp lệ: {fields["claim"]} (mã ngón tay, vd. DB1/101)'}, 400)
                 return
             
-            steps = process_fingerprint(input_img)
-            self.send_json_response({'success': True, 'steps': steps})
+            result = get_identification_service().verify(input_img, fields['claim'])
+            if result is None:
+                self.send_json_response({'error': f'Không có template nào của {fields["claim"]} trong gallery'}, 404)
+                return
+            self.send_json_response({'success': True, **result})
             
         except Exception as e:
             import traceback
@@ -317,6 +397,8 @@ if __name__ == '__main__':
         visualize_local(sys.argv[1])
     else:
         Handler = MyHTTPRequestHandler
+        service = get_identification_service()
+        print(f"🗂️ Gallery: {service.path} ({len(service)} template, nạp trong {service.load_time} ms)")
         print("=" * 70)
         print("🚀 KHỞI ĐỘNG SERVER XỬ LÝ VÂN TAY")
         print("=" * 70)
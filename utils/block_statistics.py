@@ -0,0 +1,84 @@
+"""
+Most stages of the pipeline work on (W x W) blocks of the image: segmentation thresholds the
+standard deviation of each block, the orientation estimate sums gradient products over each block
+and quality or visualisation code looks at block averages again. Instead of slicing every block and
+reducing it in Python, the image is turned once into summed-area tables (integral images), after
+which the sum over any rectangle costs four lookups and the statistics of every block of the grid
+are obtained with a handful of array operations at block resolution.
+"""
+import numpy as np
+
+
+def integral_image(im):
+    """
+    Summed-area table of im, padded with a leading row and column of zeros so that
+    sat[r, c] is the sum of im[:r, :c].
+    :param im: 2d array
+    :return: (rows + 1, cols + 1) float64 array
+    """
+    im = np.asarray(im, dtype=np.float64)
+    sat = np.zeros((im.shape[0] + 1, im.shape[1] + 1))
+    np.cumsum(im, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def integral_images(im):
+    """
+    Summed-area tables for the sum and the sum of squares of im, the pair needed for block
+    means and standard deviations. Compute them once and pass them to every stage that needs
+    block statistics of the same image.
+    :param im: 2d array
+    :return: (sat, squared_sat)
+    """
+    im = np.asarray(im, dtype=np.float64)
+    return integral_image(im), integral_image(im * im)
+
+
+def block_edges(length, w, start=0, stop=None):
+    """
+    Boundaries of the blocks range(start, length, w), the last block being cut at stop
+    (defaults to length), the same way the block loops of the pipeline use min(i + w, stop).
+    :return: (begin, end) int arrays
+    """
+    stop = length if stop is None else stop
+    begin = np.arange(start, length, w)
+    end = np.minimum(begin + w, stop)
+    return begin, np.maximum(end, begin)
+
+
+def block_sums(sat, rows, cols):
+    """
+    Sum of the image over every block of the grid rows x cols.
+    :param sat: summed-area table from integral_image
+    :param rows: (begin, end) row boundaries from block_edges
+    :param cols: (begin, end) column boundaries from block_edges
+    :return: 2d array with one value per block
+    """
+    (r0, r1), (c0, c1) = rows, cols
+    return sat[np.ix_(r1, c1)] - sat[np.ix_(r0, c1)] - sat[np.ix_(r1, c0)] + sat[np.ix_(r0, c0)]
+
+
+def block_mean_std(tables, w):
+    """
+    Mean and standard deviation of every (w x w) block of the image, blocks starting at the
+    top-left corner and the last row/column of blocks being cut by the image border.
+    :param tables: (sat, squared_sat) from integral_images
+    :param w: size of the block
+    :return: (block_mean, block_std) at block resolution
+    """
+    sat, squared_sat = tables
+    rows = block_edges(sat.shape[0] - 1, w)
+    cols = block_edges(sat.shape[1] - 1, w)
+    area = np.outer(rows[1] - rows[0], cols[1] - cols[0])
+
+    block_mean = block_sums(sat, rows, cols) / area
+    block_var = block_sums(squared_sat, rows, cols) / area - block_mean ** 2
+    return block_mean, np.sqrt(np.maximum(block_var, 0))
+
+
+def upsample_blocks(block_map, w, shape):
+    """
+    Expand a block resolution map back to an image of the given shape, each value covering its (w x w) block.
+    """
+    return np.repeat(np.repeat(block_map, w, axis=0), w, axis=1)[:shape[0], :shape[1]]
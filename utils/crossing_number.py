@@ -47,25 +47,106 @@ def minutiae_at(pixels, i, j, kernel_size):
     return "none"
 
 
-def calculate_minutiaes(im, kernel_size=3):
-    biniry_image = np.zeros_like(im)
-    biniry_image[im<10] = 1.0
-    biniry_image = biniry_image.astype(np.int8)
+# (row, column) offsets of the closed ring of neighbours walked by minutiae_at
+RING_3 = [(-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0)]
+RING_5 = [(-2, -2), (-1, -2), (0, -2), (1, -2), (2, -2), (2, -1), (2, 0), (2, 1),
+          (2, 2), (1, 2), (0, 2), (-1, 2), (-2, 2), (-2, 1), (-2, 0), (-2, -1)]
+
+MINUTIAE_TYPES = {0: "ending", 1: "bifurcation"}
+MINUTIAE_DTYPE = np.dtype([('type', np.uint8), ('x', np.int32), ('y', np.int32),
+                           ('angle', np.float32), ('quality', np.float32)])
+
+
+def crossing_number_lut(ring_length):
+    """
+    Lookup table from the packed ring code (bit k = k-th pixel of the ring) to the minutiae type:
+    0 for one crossing (ending), 1 for three crossings (bifurcation), 255 otherwise.
+    """
+    codes = np.arange(2 ** ring_length)
+    bits = (codes[:, np.newaxis] >> np.arange(ring_length)) & 1
+    crossings = np.sum(bits != np.roll(bits, -1, axis=1), axis=1) // 2
+    lut = np.full(len(codes), 255, np.uint8)
+    lut[crossings == 1] = 0
+    lut[crossings == 3] = 1
+    return lut
+
+
+_LUTS = {}
+
+
+def extract_minutiaes(im, kernel_size=3, angles=None, coherence=None, W=16):
+    """
+    Vectorized crossing number: the ring of neighbours of every pixel is packed into an integer code and all
+    pixels are classified with one lookup table. Finds the same minutiae as the minutiae_at loop.
+    :param im: skeleton image, ridges are the pixels below 10
+    :param kernel_size: 3 or 5, size of the ring of neighbours
+    :param angles: optional block orientation field from orientation.calculate_angles, gives the angle
+    :param coherence: optional block coherence from orientation.calculate_angles, gives the quality
+    :param W: block size of angles and coherence
+    :return: structured array of MINUTIAE_DTYPE (type 0 = ending, 1 = bifurcation, NaN angle/quality when
+             the block fields are not given), sorted by x then y
+    """
+    biniry_image = (im < 10).astype(np.uint32)
+    (y, x) = im.shape
+    ring = RING_3 if kernel_size == 3 else RING_5
+    radius = kernel_size // 2
+    if kernel_size not in _LUTS:
+        _LUTS[kernel_size] = crossing_number_lut(len(ring))
+
+    # the loop visits rows/columns 1 .. size - kernel_size//2 - 1; a 5x5 ring then reaches index -1,
+    # which python indexing wraps to the last row/column, hence the wrap padding
+    padded = np.pad(biniry_image, radius, mode='wrap')
+    code = np.zeros((y - radius - 1, x - radius - 1), np.uint32)
+    for bit, (dr, dc) in enumerate(ring):
+        code |= padded[1 + radius + dr:y + dr, 1 + radius + dc:x + dc] << bit
+
+    kinds = _LUTS[kernel_size][code]
+    kinds[biniry_image[1:y - radius, 1:x - radius] == 0] = 255
+
+    # column major like the drawing loop
+    cols, rows = np.nonzero(kinds.T != 255)
+    minutiaes = np.zeros(len(rows), MINUTIAE_DTYPE)
+    minutiaes['type'] = kinds[rows, cols]
+    minutiaes['x'] = cols + 1
+    minutiaes['y'] = rows + 1
+
+    # blocks of the orientation field start at pixel 1
+    block_rows = rows // W
+    block_cols = cols // W
+    for field, block_map in (('angle', angles), ('quality', coherence)):
+        if block_map is None:
+            minutiaes[field] = np.nan
+        else:
+            block_map = np.asarray(block_map)
+            minutiaes[field] = block_map[np.minimum(block_rows, block_map.shape[0] - 1),
+                                         np.minimum(block_cols, block_map.shape[1] - 1)]
+    return minutiaes
+
+
+def minutiaes_to_list(minutiaes):
+    """
+    JSON friendly list of dicts of extracted minutiaes.
+    """
+    return [{'type': MINUTIAE_TYPES[int(m['type'])], 'x': int(m['x']), 'y': int(m['y']),
+             'angle': None if np.isnan(m['angle']) else float(m['angle']),
+             'quality': None if np.isnan(m['quality']) else float(m['quality'])} for m in minutiaes]
 
+
+def draw_minutiaes(im, minutiaes):
+    """
+    Render extracted minutiaes on the skeleton image with a legend.
+    """
     (y, x) = im.shape
     result = cv.cvtColor(im, cv.COLOR_GRAY2BGR) # Use BGR for OpenCV
     # RED for Ending, GREEN for Bifurcation (BGR format)
     colors = {"ending" : (0, 0, 255), "bifurcation" : (0, 255, 0)}
 
-    # iterate each pixel minutia
-    for i in range(1, x - kernel_size//2):
-        for j in range(1, y - kernel_size//2):
-            minutiae = minutiae_at(biniry_image, j, i, kernel_size)
-            if minutiae != "none":
-                # Draw filled circle with small radius
-                cv.circle(result, (i,j), radius=3, color=colors[minutiae], thickness=-1)
-                # Optional: Add white contour for better visibility
-                # cv.circle(result, (i,j), radius=3, color=(255,255,255), thickness=1)
+    for minutiae in minutiaes:
+        # Draw filled circle with small radius
+        color = colors[MINUTIAE_TYPES[int(minutiae['type'])]]
+        cv.circle(result, (int(minutiae['x']), int(minutiae['y'])), radius=3, color=color, thickness=-1)
+        # Optional: Add white contour for better visibility
+        # cv.circle(result, (i,j), radius=3, color=(255,255,255), thickness=1)
 
     # --- ADD LEGEND ON IMAGE ---
     # Box background (White)
@@ -90,3 +171,7 @@ def calculate_minutiaes(im, kernel_size=3):
                cv.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv.LINE_AA)
 
     return result
+
+
+def calculate_minutiaes(im, kernel_size=3):
+    return draw_minutiaes(im, extract_minutiaes(im, kernel_size))
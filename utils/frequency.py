@@ -1,6 +1,7 @@
 import numpy as np
 import math
 import scipy.ndimage
+from utils.block_statistics import upsample_blocks
 
 
 def frequest(im, orientim, kernel_size, minWaveLength, maxWaveLength):
@@ -49,26 +50,95 @@ def frequest(im, orientim, kernel_size, minWaveLength, maxWaveLength):
     return(freq_block)
 
 
+def block_ridge_signatures(im, rows, cols, orient, block_size, rotation=np.pi/2, projection_axis=0):
+    """
+    Batched form of the rotate / crop / sum steps of frequest: the oriented sampling grid of the
+    rotated and cropped block is built for every block at once and the image is sampled in a single
+    cubic spline map_coordinates call, instead of one scipy.ndimage.rotate per block.
+    :param im: image
+    :param rows: top row of every block
+    :param cols: left column of every block
+    :param orient: ridge orientation of every block
+    :param block_size: size of the block
+    :param rotation: angle added to the block orientation to rotate the block, pi/2 makes the ridges vertical
+    :param projection_axis: axis of the rotated block that is summed, 0 sums down the columns
+    :return: (n_blocks, cropsze) projection of the grey values down the ridges of every block
+    """
+    # same mean orientation and rotation angle as frequest
+    block_orient = np.arctan2(np.sin(2*orient), np.cos(2*orient))/2
+    cos_r = np.cos(block_orient + rotation)[:, np.newaxis, np.newaxis]
+    sin_r = np.sin(block_orient + rotation)[:, np.newaxis, np.newaxis]
+
+    # output pixels of the cropped rotated block, relative to the block centre
+    cropsze = int(np.fix(block_size/np.sqrt(2)))
+    offset = int(np.fix((block_size-cropsze)/2))
+    centre = (block_size - 1)/2
+    grid = np.arange(offset, offset + cropsze) - centre
+    v = grid[np.newaxis, :, np.newaxis]
+    u = grid[np.newaxis, np.newaxis, :]
+
+    # input pixel sampled by scipy.ndimage.rotate for every output pixel
+    sample_rows = cos_r*v + sin_r*u + centre + np.asarray(rows)[:, np.newaxis, np.newaxis]
+    sample_cols = -sin_r*v + cos_r*u + centre + np.asarray(cols)[:, np.newaxis, np.newaxis]
+    rotim = scipy.ndimage.map_coordinates(np.double(im), [sample_rows, sample_cols], order=3, mode='nearest')
+
+    # Sum down the columns to get a projection of the grey values down the ridges.
+    return np.sum(rotim, axis=projection_axis + 1)
+
+
+def signature_frequencies(ridge_sum, kernel_size, minWaveLength, maxWaveLength):
+    """
+    Peak counting of frequest applied to a stack of ridge projections.
+    :param ridge_sum: (n_blocks, n) ridge projections
+    :return: (n_blocks,) ridge frequency of every block, 0 when it cannot be found within the limits
+    """
+    n_blocks, n = ridge_sum.shape
+    dilation = scipy.ndimage.grey_dilation(ridge_sum, (1, kernel_size), structure=np.ones((1, kernel_size)))
+    ridge_noise = np.abs(dilation - ridge_sum); peak_thresh = 2
+    maxpts = (ridge_noise < peak_thresh) & (ridge_sum > np.mean(ridge_sum, axis=1, keepdims=True))
+
+    no_of_peaks = np.sum(maxpts, axis=1)
+    first_peak = np.argmax(maxpts, axis=1)
+    last_peak = n - 1 - np.argmax(maxpts[:, ::-1], axis=1)
+    waveLength = (last_peak - first_peak)/np.maximum(no_of_peaks - 1, 1)
+
+    valid = (no_of_peaks >= 2) & (waveLength >= minWaveLength) & (waveLength <= maxWaveLength)
+    return np.divide(1, waveLength, out=np.zeros(n_blocks), where=valid)
+
+
+def ridge_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength,
+                   rotation=np.pi/2, projection_axis=0):
+    """
+    Batched ridge frequency estimation over every block of the image.
+    :param rotation: see block_ridge_signatures
+    :param projection_axis: see block_ridge_signatures
+    :return: (block_freq, medianfreq) the frequency of every (block_size x block_size) block (0 where
+             it cannot be found) and the median frequency of the masked image
+    """
+    rows, cols = im.shape
+    block_freq = np.zeros((-(-rows // block_size), -(-cols // block_size)))
+
+    block_rows, block_cols = np.meshgrid(np.arange(0, rows - block_size, block_size),
+                                         np.arange(0, cols - block_size, block_size), indexing='ij')
+    angle_block = orient[block_rows // block_size, block_cols // block_size]
+    used = angle_block != 0
+    block_rows, block_cols, angle_block = block_rows[used], block_cols[used], angle_block[used]
+
+    if len(angle_block):
+        ridge_sum = block_ridge_signatures(im, block_rows, block_cols, angle_block, block_size,
+                                           rotation, projection_axis)
+        block_freq[block_rows // block_size, block_cols // block_size] = \
+            signature_frequencies(ridge_sum, kernel_size, minWaveLength, maxWaveLength)
+
+    freq = upsample_blocks(block_freq, block_size, im.shape) * mask
+    non_zero_elems_in_freq = freq[freq > 0]
+    medianfreq = np.median(non_zero_elems_in_freq)
+
+    return block_freq, medianfreq
+
+
 def ridge_freq(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength):
     # Function to estimate the fingerprint ridge frequency across a
     # fingerprint image.
-    rows,cols = im.shape
-    freq = np.zeros((rows,cols))
-
-    for row in range(0, rows - block_size, block_size):
-        for col in range(0, cols - block_size, block_size):
-            image_block = im[row:row + block_size][:, col:col + block_size]
-            angle_block = orient[row // block_size][col // block_size]
-            if angle_block:
-                freq[row:row + block_size][:, col:col + block_size] = frequest(image_block, angle_block, kernel_size,
-                                                                               minWaveLength, maxWaveLength)
-
-    freq = freq*mask
-    freq_1d = np.reshape(freq,(1,rows*cols))
-    ind = np.where(freq_1d>0)
-    ind = np.array(ind)
-    ind = ind[1,:]
-    non_zero_elems_in_freq = freq_1d[0][ind]
-    medianfreq = np.median(non_zero_elems_in_freq) * mask
-
-    return medianfreq
+    _, medianfreq = ridge_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength)
+    return medianfreq * mask
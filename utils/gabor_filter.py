@@ -9,9 +9,119 @@ the base filters in the direction and local frequency from the two directional a
 https://airccj.org/CSCP/vol7/csit76809.pdf pg.91
 """
 
+import os
+from collections import OrderedDict
 import numpy as np
-import scipy
-def gabor_filter(im, orient, freq, kx=0.65, ky=0.65):
+import cv2 as cv
+
+# Filter banks already generated, keyed by (frequency rounded to 0.01, kx, ky, angleInc), least
+# recently used first. ridge_freq returns a single median frequency, so a handful of banks serve
+# every image of a dataset.
+GABOR_BANK_CACHE_SIZE = 16
+_gabor_banks = OrderedDict()
+
+
+def _gabor_bank_key(freq, kx, ky, angleInc):
+    return (float(np.round(freq*100))/100, float(kx), float(ky), int(angleInc))
+
+
+def make_gabor_bank(freq, kx=0.65, ky=0.65, angleInc=3):
+    """
+    Generate the filters for one frequency and the orientations in 'angleInc' increments.
+    The kernels are evaluated analytically on a rotated grid, which matches rotating the reference
+    filter by -(degree*angleInc + 90) degrees up to interpolation error (< 0.005).
+    :return: (180//angleInc, 2*block_size + 1, 2*block_size + 1) array
+    """
+    sigma_x = 1/freq*kx
+    sigma_y = 1/freq*ky
+    block_size = int(np.round(3*np.max([sigma_x,sigma_y])))
+    array = np.linspace(-block_size,block_size,(2*block_size + 1))
+    x, y = np.meshgrid(array, array)
+
+    theta = np.deg2rad(np.arange(0, 180//angleInc)*angleInc + 90)[:, np.newaxis, np.newaxis]
+    x_theta = x*np.cos(theta) + y*np.sin(theta)
+    y_theta = -x*np.sin(theta) + y*np.cos(theta)
+
+    # gabor filter equation
+    gabor_bank = np.exp(-(((np.power(x_theta,2))/(sigma_x*sigma_x) + (np.power(y_theta,2))/(sigma_y*sigma_y)))) * np.cos(2*np.pi*freq*x_theta)
+    gabor_bank.setflags(write=False)
+    return gabor_bank
+
+
+def get_gabor_bank(freq, kx=0.65, ky=0.65, angleInc=3):
+    """
+    Cached make_gabor_bank, the frequency being rounded to the nearest 0.01 like in gabor_filter.
+    The returned bank is shared and read only.
+    """
+    key = _gabor_bank_key(freq, kx, ky, angleInc)
+    gabor_bank = _gabor_banks.get(key)
+    if gabor_bank is None:
+        gabor_bank = make_gabor_bank(*key)
+        _gabor_banks[key] = gabor_bank
+        while len(_gabor_banks) > GABOR_BANK_CACHE_SIZE:
+            _gabor_banks.popitem(last=False)
+    else:
+        _gabor_banks.move_to_end(key)
+    return gabor_bank
+
+
+def save_gabor_banks(path):
+    """
+    Persist the cached filter banks to an .npz archive (one .npy entry per bank) so that worker
+    processes can start with a warm cache through load_gabor_banks.
+    """
+    banks = {'%r_%r_%r_%d' % key: bank for key, bank in _gabor_banks.items()}
+    np.savez(path, **banks)
+
+
+def load_gabor_banks(path):
+    """
+    Fill the cache with the banks saved by save_gabor_banks. Missing files are ignored.
+    :return: number of banks loaded
+    """
+    if not os.path.exists(path):
+        return 0
+    with np.load(path) as banks:
+        for name in banks.files:
+            freq, kx, ky, angleInc = name.split('_')
+            gabor_bank = banks[name]
+            gabor_bank.setflags(write=False)
+            _gabor_banks[_gabor_bank_key(float(freq), float(kx), float(ky), int(angleInc))] = gabor_bank
+    while len(_gabor_banks) > GABOR_BANK_CACHE_SIZE:
+        _gabor_banks.popitem(last=False)
+    return len(banks.files)
+
+
+def orientation_bucketed_filter(im, pixel_rows, pixel_cols, pixel_orient, gabor_bank):
+    """
+    Filter the given pixels of im, each one with the filter of its own orientation.
+    Pixels are grouped by orientation index and each used orientation costs one cv.filter2D over the
+    bounding box of its pixels (OpenCV switches to a DFT based correlation for large kernels); the
+    response is only kept at the pixels of that orientation.
+    Every pixel must be at least the filter radius away from the image border.
+    :param im: 2d float image
+    :param pixel_rows: rows of the pixels to filter
+    :param pixel_cols: columns of the pixels to filter
+    :param pixel_orient: index in gabor_bank of the filter of every pixel
+    :param gabor_bank: (n_orientations, 2*block_size + 1, 2*block_size + 1) filters
+    :return: (filtered image, 0 outside the given pixels, number of orientations convolved)
+    """
+    block_size = gabor_bank.shape[1] // 2
+    return_img = np.zeros(im.shape)
+
+    order = np.argsort(pixel_orient, kind='stable')
+    used_orient, first = np.unique(pixel_orient[order], return_index=True)
+    for orient_index, bucket in zip(used_orient, np.split(order, first[1:])):
+        r = pixel_rows[bucket]; c = pixel_cols[bucket]
+        top = r.min() - block_size; left = c.min() - block_size
+        window = im[top:r.max() + block_size + 1, left:c.max() + block_size + 1]
+        response = cv.filter2D(window, cv.CV_64F, gabor_bank[orient_index], borderType=cv.BORDER_CONSTANT)
+        return_img[r, c] = response[r - top, c - left]
+
+    return return_img, len(used_orient)
+
+
+def gabor_filter(im, orient, freq, kx=0.65, ky=0.65, return_orientations=False):
     """
     Gabor filter is a linear filter used for edge detection. Gabor filter can be viewed as a sinusoidal plane of
     particular frequency and orientation, modulated by a Gaussian envelope.
@@ -20,12 +130,12 @@ def gabor_filter(im, orient, freq, kx=0.65, ky=0.65):
     :param freq:
     :param kx:
     :param ky:
+    :param return_orientations: also return the number of orientations that were convolved
     :return:
     """
     angleInc = 3
     im = np.double(im)
     rows, cols = im.shape
-    return_img = np.zeros((rows,cols))
 
     # Round the array of frequencies to the nearest 0.01 to reduce the
     # number of distinct frequencies we have to deal with.
@@ -35,45 +145,29 @@ def gabor_filter(im, orient, freq, kx=0.65, ky=0.65):
     non_zero_elems_in_freq = np.double(np.round((non_zero_elems_in_freq*100)))/100
     unfreq = np.unique(non_zero_elems_in_freq)
 
-    # Generate filters corresponding to these distinct frequencies and
-    # orientations in 'angleInc' increments.
-    sigma_x = 1/unfreq*kx
-    sigma_y = 1/unfreq*ky
-    block_size = int(np.round(3*np.max([sigma_x,sigma_y])))
-    array = np.linspace(-block_size,block_size,(2*block_size + 1))
-    x, y = np.meshgrid(array, array)
-
-    # gabor filter equation
-    reffilter = np.exp(-(((np.power(x,2))/(sigma_x*sigma_x) + (np.power(y,2))/(sigma_y*sigma_y)))) * np.cos(2*np.pi*unfreq[0]*x)
-    filt_rows, filt_cols = reffilter.shape
-    gabor_filter = np.array(np.zeros((180//angleInc, filt_rows, filt_cols)))
-
-    # Generate rotated versions of the filter.
-    for degree in range(0,180//angleInc):
-        rot_filt = scipy.ndimage.rotate(reffilter,-(degree*angleInc + 90),reshape = False)
-        gabor_filter[degree] = rot_filt
+    # Filters corresponding to these distinct frequencies and
+    # orientations in 'angleInc' increments, from the filter bank cache.
+    gabor_filter = get_gabor_bank(unfreq[0], kx, ky, angleInc)
+    block_size = gabor_filter.shape[1] // 2
 
     # Convert orientation matrix values from radians to an index value that corresponds to round(degrees/angleInc)
     maxorientindex = np.round(180/angleInc)
     orientindex = np.round(orient/np.pi*180/angleInc)
-    for i in range(0,rows//16):
-        for j in range(0,cols//16):
-            if(orientindex[i][j] < 1):
-                orientindex[i][j] = orientindex[i][j] + maxorientindex
-            if(orientindex[i][j] > maxorientindex):
-                orientindex[i][j] = orientindex[i][j] - maxorientindex
+    blocks = orientindex[:rows//16, :cols//16]
+    blocks[blocks < 1] += maxorientindex
+    blocks[blocks > maxorientindex] -= maxorientindex
 
     # Find indices of matrix points greater than maxsze from the image boundary
-    block_size = int(block_size)
     valid_row, valid_col = np.where(freq>0)
     finalind = \
         np.where((valid_row>block_size) & (valid_row<rows - block_size) & (valid_col>block_size) & (valid_col<cols - block_size))
+    r = valid_row[finalind]; c = valid_col[finalind]
 
-    for k in range(0, np.shape(finalind)[1]):
-        r = valid_row[finalind[0][k]]; c = valid_col[finalind[0][k]]
-        img_block = im[r-block_size:r+block_size + 1][:,c-block_size:c+block_size + 1]
-        return_img[r][c] = np.sum(img_block * gabor_filter[int(orientindex[r//16][c//16]) - 1])
+    return_img, n_orientations = orientation_bucketed_filter(
+        im, r, c, orientindex[r//16, c//16].astype(int) - 1, gabor_filter)
 
     gabor_img = 255 - np.array((return_img < 0)*255).astype(np.uint8)
 
+    if return_orientations:
+        return gabor_img, n_orientations
     return gabor_img
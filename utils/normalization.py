@@ -23,13 +23,42 @@ def normalize_pixel(x, v0, v, m, m0):
     dev_coeff = sqrt((v0 * ((x - m)**2)) / v)
     return m0 + dev_coeff if x > m else m0 - dev_coeff
 
-def normalize(im, m0, v0):
-    m = np.mean(im)
-    v = np.std(im) ** 2
-    (y, x) = im.shape
-    normilize_image = im.copy()
-    for i in range(x):
-        for j in range(y):
-            normilize_image[j, i] = normalize_pixel(im[j, i], v0, v, m, m0)
 
-    return normilize_image
+def normalize(im, m0, v0, out=None):
+    """
+    Vectorized form of normalize_pixel applied to the whole image in one array pass.
+    Works on a single (H, W) image or on a (N, H, W) stack, in which case every image is
+    normalized with its own mean and variance.
+    :param im: 2d image or 3d stack of images
+    :param m0: desired mean
+    :param v0: desired variance
+    :param out: optional array with the shape of im that receives the result (may be im itself).
+                A floating point out is used as the work buffer, so a batch runner can reuse one
+                buffer for every fingerprint instead of allocating a new float image each time.
+    :return: normilized image, same dtype as im (or out)
+    """
+    im = np.asarray(im)
+    flat = im.reshape(im.shape[:-2] + (-1,))
+    m = np.mean(flat, axis=-1)[..., np.newaxis, np.newaxis]
+    v = (np.std(flat, axis=-1) ** 2)[..., np.newaxis, np.newaxis]
+
+    if out is None:
+        out = np.empty_like(im)
+    if np.issubdtype(out.dtype, np.floating):
+        buffer = out
+    else:
+        buffer = np.empty(im.shape)
+
+    # same operation order as normalize_pixel so the result matches it bit for bit
+    np.subtract(im, m, out=buffer)
+    below_mean = buffer <= 0
+    np.square(buffer, out=buffer)
+    np.multiply(v0, buffer, out=buffer)
+    np.divide(buffer, v, out=buffer)
+    np.sqrt(buffer, out=buffer)
+    np.negative(buffer, out=buffer, where=below_mean)
+    np.add(m0, buffer, out=buffer)
+
+    if buffer is not out:
+        np.copyto(out, buffer, casting='unsafe')
+    return out
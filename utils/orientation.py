@@ -1,60 +1,77 @@
 import math
 import numpy as np
 import cv2 as cv
+from utils.block_statistics import integral_image, block_edges, block_sums
 
+# first pixel of the first block of block_orientation, blocks then follow every W pixels
+BLOCK_START = 1
 
-def calculate_angles(im, W, smoth=False):
+
+def block_centre(index, W):
+    """
+    Pixel at the centre of block index of block_orientation (along either axis).
+    """
+    return BLOCK_START + index * W + W // 2
+
+
+def block_coordinate(pixel, W):
+    """
+    Inverse of block_centre: fractional block index of a pixel position, block k being centred on k.
+    """
+    return (pixel - BLOCK_START - W // 2) / W
+
+
+def block_orientation(Gx_, Gy_, W):
+    """
+    Vectorized block orientation engine shared by calculate_angles implementations.
+    The gradients are rounded to integers exactly like the former per-pixel loop, so the block sums of
+    2*Gx*Gy and Gx^2 - Gy^2 taken from summed-area tables are exact integers in float64 and equal to the
+    loop sums; the angles then only differ from the loop by the last bit of atan2 (below 1e-12 rad).
+    Blocks start at pixel 1 every W pixels and stop one pixel before the image border.
+    :param Gx_: horizontal gradients
+    :param Gy_: vertical gradients
+    :param W: int width of the ridge
+    :return: (angles, coherence) one value per block, coherence = |sum of j1, j2| / sum of j3 in [0, 1]
+    """
+    (y, x) = Gx_.shape
+    Gx = np.round(Gx_)
+    Gy = np.round(Gy_)
+
+    rows = block_edges(y, W, start=BLOCK_START, stop=y - 1)
+    cols = block_edges(x, W, start=BLOCK_START, stop=x - 1)
+    nominator = block_sums(integral_image(2 * Gx * Gy), rows, cols)
+    denominator = block_sums(integral_image(Gx ** 2 - Gy ** 2), rows, cols)
+    energy = block_sums(integral_image(Gx ** 2 + Gy ** 2), rows, cols)
+
+    defined = (nominator != 0) | (denominator != 0)
+    angles = np.where(defined, (np.pi + np.arctan2(nominator, denominator)) / 2, 0)
+    coherence = np.divide(np.hypot(nominator, denominator), energy, out=np.zeros_like(energy), where=energy > 0)
+    return angles, coherence
+
+
+def calculate_angles(im, W, smoth=False, return_coherence=False):
     """
     anisotropy orientation estimate, based on equations 5 from:
     https://pdfs.semanticscholar.org/6e86/1d0b58bdf7e2e2bb0ecbf274cee6974fe13f.pdf
     :param im:
     :param W: int width of the ridge
-    :return: array
+    :param return_coherence: also return the coherence (reliability) of every block
+    :return: array, or (array, coherence) when return_coherence is set
     """
-    j1 = lambda x, y: 2 * x * y
-    j2 = lambda x, y: x ** 2 - y ** 2
-    j3 = lambda x, y: x ** 2 + y ** 2
-
-    (y, x) = im.shape
-
     sobelOperator = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
     ySobel = np.array(sobelOperator).astype(int)
     xSobel = np.transpose(ySobel).astype(int)
 
-    result = [[] for i in range(1, y, W)]
-
     Gx_ = cv.filter2D(im/125,-1, ySobel)*125
     Gy_ = cv.filter2D(im/125,-1, xSobel)*125
 
-    for j in range(1, y, W):
-        for i in range(1, x, W):
-            nominator = 0
-            denominator = 0
-            for l in range(j, min(j + W, y - 1)):
-                for k in range(i, min(i + W , x - 1)):
-                    Gx = round(Gx_[l, k])  # horizontal gradients at l, k
-                    Gy = round(Gy_[l, k])  # vertial gradients at l, k
-                    nominator += j1(Gx, Gy)
-                    denominator += j2(Gx, Gy)
-
-            # nominator = round(np.sum(Gy_[j:min(j + W, y - 1), i:min(i + W , x - 1)]))
-            # denominator = round(np.sum(Gx_[j:min(j + W, y - 1), i:min(i + W , x - 1)]))
-            if nominator or denominator:
-                angle = (math.pi + math.atan2(nominator, denominator)) / 2
-                orientation = np.pi/2 + math.atan2(nominator,denominator)/2
-                result[int((j-1) // W)].append(angle)
-            else:
-                result[int((j-1) // W)].append(0)
-
-            # segment image
-            # focus_img = im[j:min(j + W, y - 1), i:min(i + W , x - 1)]
-            # segmentator = -1 if segmentator/W*W < np.max(focus_img)*
-
-    result = np.array(result)
+    result, coherence = block_orientation(Gx_, Gy_, W)
 
     if smoth:
         result = smooth_angles(result)
 
+    if return_coherence:
+        return result, coherence
     return result
 
 
@@ -1,7 +1,9 @@
 from utils import orientation
+from utils.orientation import block_centre
 import math
 import cv2 as cv
 import numpy as np
+from utils.block_statistics import integral_image, block_edges, block_sums
 
 def poincare_index_at(i, j, angles, tolerance):
     """
@@ -14,7 +16,8 @@ def poincare_index_at(i, j, angles, tolerance):
     angles_around_index = [math.degrees(angles[i - k][j - l]) for k, l in cells]
     index = 0
     for k in range(0, 8):
-        difference = angles_around_index[k] - angles_around_index[k + 1]
+        # cells are listed against the direction in which the angles of calculate_angles grow: a core turns by +180
+        difference = angles_around_index[k + 1] - angles_around_index[k]
         if difference > 90:
             difference -= 180
         elif difference < -90:
@@ -30,37 +33,92 @@ def poincare_index_at(i, j, angles, tolerance):
     return "none"
 
 
-def calculate_singularities(im, angles, tolerance, W, mask):
-    result = cv.cvtColor(im, cv.COLOR_GRAY2BGR) # BGR Consistent
+def poincare_index_map(angles):
+    """
+    poincare_index_at for every block of the grid at once with shifted copies of the angle field,
+    differences being added in the same order as the loop.
+    :return: poincare index in degrees, nan on the first/last row and column of blocks
+    """
+    cells = [(-1, -1), (-1, 0), (-1, 1),         # p1 p2 p3
+            (0, 1),  (1, 1),  (1, 0),            # p8    p4
+            (1, -1), (0, -1), (-1, -1)]          # p7 p6 p5
+
+    degrees = np.asarray(angles, dtype=np.float64) / (math.pi / 180)   # same rounding as math.degrees
+    rows, cols = degrees.shape
+    index_map = np.full((rows, cols), np.nan)
+    if rows < 3 or cols < 3:
+        return index_map
+
+    around = [degrees[1 - k:rows - 1 - k, 1 - l:cols - 1 - l] for k, l in cells]
+    index = np.zeros((rows - 2, cols - 2))
+    for k in range(0, 8):
+        difference = around[k + 1] - around[k]
+        difference = np.where(difference > 90, difference - 180, np.where(difference < -90, difference + 180, difference))
+        index += difference
+    index_map[1:-1, 1:-1] = index
+    return index_map
+
 
-    # BGR Colors
-    colors = {
-        "loop": (0, 165, 255),    # Orange (Core)
-        "delta": (255, 0, 0),      # Blue (Delta)
-        "whorl": (255, 0, 255)     # Magenta (Whorl)
-    }
-
-    for i in range(3, len(angles) - 2):             # Y
-        for j in range(3, len(angles[i]) - 2):      # x
-            mask_slice = mask[(i-2)*W:(i+3)*W, (j-2)*W:(j+3)*W]
-            mask_flag = np.sum(mask_slice)
-            if mask_flag == (W*5)**2:
-                singularity = poincare_index_at(i, j, angles, tolerance)
-                if singularity != "none":
-                    center_x = (j * W) + (W // 2)
-                    center_y = (i * W) + (W // 2)
-                    box_size = W + 2
-                    # Màu: cam (core), đỏ (delta), tím (whorl)
-                    color = (0, 165, 255) if singularity == "loop" else ((0, 0, 255) if singularity == "delta" else (255, 0, 255))
-                    thickness = 2 if singularity == "delta" else 2
-                    # Vẽ ô vuông (rectangle) tại vị trí singularity
-                    top_left = (center_x - box_size//2, center_y - box_size//2)
-                    bottom_right = (center_x + box_size//2, center_y + box_size//2)
-                    cv.rectangle(result, top_left, bottom_right, color, thickness)
+def detect_singularities(angles, tolerance, W, mask):
+    """
+    Vectorized singular point detection over the block grid: blocks whose 5x5 block neighbourhood is fully inside the
+    mask (checked with block sums of the mask) and whose poincare index is close to 180 (loop/core), -180 (delta)
+    or 360 (whorl) degrees.
+    :return: list of (singularity, (x, y)) with the pixel centre of the block (block_centre), in row by row block order
+    """
+    angles = np.asarray(angles)
+    rows, cols = angles.shape
+    index_map = poincare_index_map(angles)
+
+    # blocks completely covered by the mask, then 5x5 block neighbourhoods made only of such blocks
+    block_full = block_sums(integral_image(mask), block_edges(mask.shape[0], W), block_edges(mask.shape[1], W)) == W * W
+    full_blocks = np.zeros((rows + 3, cols + 3))
+    block_full = block_full[:rows + 3, :cols + 3]
+    full_blocks[:block_full.shape[0], :block_full.shape[1]] = block_full
+    center_i = np.arange(3, rows - 2)
+    center_j = np.arange(3, cols - 2)
+    full_window = block_sums(integral_image(full_blocks), (center_i - 2, center_i + 3), (center_j - 2, center_j + 3)) == 25
+
+    candidates = np.zeros((rows, cols), dtype=bool)
+    candidates[3:rows - 2, 3:cols - 2] = full_window
+
+    singularity = np.select([(180 - tolerance <= index_map) & (index_map <= 180 + tolerance),
+                             (-180 - tolerance <= index_map) & (index_map <= -180 + tolerance),
+                             (360 - tolerance <= index_map) & (index_map <= 360 + tolerance)],
+                            ["loop", "delta", "whorl"], "none")
+    singularity[~candidates] = "none"
+
+    block_i, block_j = np.nonzero(singularity != "none")
+    return [(str(singularity[i, j]), (int(block_centre(j, W)), int(block_centre(i, W)))) for i, j in zip(block_i, block_j)]
 
 
+def draw_singularities(im, singularities, W):
+    result = cv.cvtColor(im, cv.COLOR_GRAY2BGR) # BGR Consistent
+
+    for singularity, (center_x, center_y) in singularities:
+        box_size = W + 2
+        # Màu: cam (core), đỏ (delta), tím (whorl)
+        color = (0, 165, 255) if singularity == "loop" else ((0, 0, 255) if singularity == "delta" else (255, 0, 255))
+        thickness = 2 if singularity == "delta" else 2
+        # Vẽ ô vuông (rectangle) tại vị trí singularity
+        top_left = (center_x - box_size//2, center_y - box_size//2)
+        bottom_right = (center_x + box_size//2, center_y + box_size//2)
+        cv.rectangle(result, top_left, bottom_right, color, thickness)
+
     return result
 
+
+def calculate_singularities(im, angles, tolerance, W, mask):
+    return draw_singularities(im, detect_singularities(angles, tolerance, W, mask), W)
+
 if __name__ == '__main__':
-    img = cv.imread('../test_img.png', 0)
-    # Testing code...
+    # python -m utils.poincare: synthetic fields around the centre of a 9x9 block grid, the orientation turning by
+    # +180 degrees along a turn of the polar angle for a core and by -180 degrees for a delta
+    W = 16
+    i, j = np.mgrid[0:9, 0:9]
+    polar = np.arctan2(i - 3.5, j - 3.5)
+    mask = np.ones((9 * W, 9 * W))
+    for name, field, expected in (("core", polar / 2, "loop"), ("delta", -polar / 2, "delta")):
+        found = set(singularity for singularity, _ in detect_singularities(np.mod(field, math.pi), 10, W, mask))
+        scalar = poincare_index_at(4, 4, np.mod(field, math.pi), 10)
+        print("%s field: %s (poincare_index_at %s), expected %s" % (name, ", ".join(sorted(found)), scalar, expected))
@@ -13,13 +13,14 @@ optimize the extraction phase of the biometric data.
 """
 import numpy as np
 import cv2 as cv
+from utils.block_statistics import integral_images, block_mean_std, upsample_blocks
 
 
 def normalise(img):
     return (img - np.mean(img))/(np.std(img))
 
 
-def create_segmented_and_variance_images(im, w, threshold=.2):
+def create_segmented_and_variance_images(im, w, threshold=.2, tables=None):
     """
     Returns mask identifying the ROI. Calculates the standard deviation in each image block and threshold the ROI
     It also normalises the intesity values of
@@ -28,23 +29,21 @@ def create_segmented_and_variance_images(im, w, threshold=.2):
     :param im: Image
     :param w: size of the block
     :param threshold: std threshold
+    :param tables: optional (sat, squared_sat) of im from utils.block_statistics.integral_images,
+                   computed here when not given
     :return: segmented_image
     """
-    (y, x) = im.shape
     threshold = np.std(im)*threshold
 
-    image_variance = np.zeros(im.shape)
-    segmented_image = im.copy()
-    mask = np.ones_like(im)
+    # block standard deviations from the summed-area tables, only the mask goes back to full resolution
+    if tables is None:
+        tables = integral_images(im)
+    _, block_stddev = block_mean_std(tables, w)
 
-    for i in range(0, x, w):
-        for j in range(0, y, w):
-            box = [i, j, min(i + w, x), min(j + w, y)]
-            block_stddev = np.std(im[box[1]:box[3], box[0]:box[2]])
-            image_variance[box[1]:box[3], box[0]:box[2]] = block_stddev
+    segmented_image = im.copy()
 
     # apply threshold
-    mask[image_variance < threshold] = 0
+    mask = upsample_blocks(block_stddev >= threshold, w, im.shape).astype(im.dtype)
 
     # smooth mask with a open/close morphological filter
     kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE,(w*2, w*2))